@@ -5,6 +5,40 @@ import argparse
 import getpass
 import pysvn
 import functools
+import threading
+import sqlite3
+import time
+import pickle
+import urllib
+import re
+import signal
+import json
+import shutil
+
+from array import array
+from multiprocessing.pool import ThreadPool
+
+if os.name == 'nt':
+    import ctypes
+
+    def _hardlink(src, dst):
+        if not ctypes.windll.kernel32.CreateHardLinkW(unicode(dst), unicode(src), None):
+            raise OSError('Failed to hardlink %s' % src)
+else:
+    _hardlink = os.link
+
+try:
+    import resource # Not available on windows
+except ImportError:
+    resource = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # Backport package for python 2
+    except ImportError:
+        scandir = None
 
 _wcna = pysvn.wc_notify_action
 INTERESTING_NOTIFICATIONS = [ 
@@ -17,6 +51,40 @@ INTERESTING_NOTIFICATIONS = [
     _wcna.update_delete,
     _wcna.update_external ]
 
+DEFAULT_LS_JOBS = 8
+MAX_UPDATE_BATCH = 500 # Max targets handed to a single svn update call
+BULK_LS_THRESHOLD = 64 # Sparse folders below a top level folder before 'auto' lists it recursively
+PLANNER_MODES = ('auto', 'ls', 'bulk')
+DEFAULT_LS_CACHE_SIZE = 256 * 1024 * 1024 # Bytes of listings kept in the persistent ls cache
+GLOB_CHARS = '*'
+
+# Results of SparseProfile.classify()
+EXCLUDED = 'excluded'
+INCLUDED = 'included'
+PARTIAL = 'partial' # Some descendants are affected by different rules
+
+# Stored in the working copy's .svn folder
+SPARSE_STATE_FILENAME = 'sparse_checkout.state'
+SPARSE_JOURNAL_FILENAME = 'sparse_checkout.journal'
+SPARSE_EXPORT_MANIFEST = '.sparse_export' # Stored in the root of an export
+
+# Update depth -> (pysvn depth, is sticky)
+UPDATE_DEPTHS = {
+    'unknown': (pysvn.depth.unknown, False), # Keep the working copy's existing depths
+    'exclude': (pysvn.depth.exclude, True),
+    'empty': (pysvn.depth.empty, True),
+    'infinity': (pysvn.depth.infinity, True) }
+PROGRESS_INTERVAL = 0.5 # Seconds between progress line refreshes
+
+# Phase names reported for each kind of update operation
+UPDATE_PHASES = {
+    'unknown': 'revision update',
+    'exclude': 'exclusions',
+    'empty': 'empty updates',
+    'infinity': 'infinite updates' }
+
+_POOL_TIMEOUT = 60 * 60 * 24 # map_async().get() needs a timeout to stay ctrl+c interruptible
+
 def ssl_server_trust_prompt(trust_dict):
     return True, trust_dict['failures'], True
 
@@ -29,10 +97,8 @@ def get_login(realm, username, may_save):
 
 _SHOULD_CANCEL = False
 def _kb_int_except_hook(type, value, traceback):
-    global _SHOULD_CANCEL
     if type == KeyboardInterrupt:
-        #_SHOULD_CANCEL = True
-        sys.exit(1) # TODO: cleaner ctrl+c handling
+        sys.exit(1)
 
     _original_except_hook(type, value, traceback)
 
@@ -40,8 +106,19 @@ _original_except_hook = sys.excepthook
 
 sys.excepthook = _kb_int_except_hook
 
-#def svn_cancel_callback():
-#    return _SHOULD_CANCEL
+
+def _sigint_handler(signum, frame):
+    # First ctrl+c asks svn to cancel cleanly, so the journal stays consistent
+    # and the checkout can be resumed. A second one gives up immediately.
+    global _SHOULD_CANCEL
+    if _SHOULD_CANCEL:
+        raise KeyboardInterrupt
+    _SHOULD_CANCEL = True
+    print 'Cancelling... (ctrl+c again to abort immediately)'
+
+
+def svn_cancel_callback():
+    return _SHOULD_CANCEL
 
 
 def norm_drive_case(path):
@@ -60,13 +137,138 @@ def svn_notification_callback(abs_base_path, event):
         print '[%s] %s @ %d' % (str(event['action']).upper(), path, int(event['revision'].number))
 
 
-def parse_conf_file(filename):
+def format_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            return '%.1f %s' % (n, unit)
+        n /= 1024.0
+    return '%.1f TB' % n
+
+
+class ProgressReporter(object):
+    """
+    Aggregates svn notifications into counters instead of printing a line per
+    file. Keeps per action counts, file and byte throughput, and wall time per
+    phase. On a terminal a single progress line is refreshed at a fixed rate;
+    a summary is printed at the end and can also be written out as JSON.
+    Per file output is still available at verbosity 2 and above. Exports
+    notify from several worker threads at once, so updates take a lock.
+    """
+    def __init__(self, abs_base_path, verbose, interval=PROGRESS_INTERVAL):
+        self.abs_base_path = abs_base_path
+        self.per_file = verbose >= 2
+        self.live = sys.stdout.isatty() and not self.per_file
+        self.interval = interval
+        self.action_counts = {}
+        self.files = 0
+        self.bytes = 0
+        self.phase_times = [] # [ [name, seconds], ... ] in the order first run
+        self._phase = None
+        self._phase_start = 0
+        self._session_bytes = 0
+        self._last_refresh = 0
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def notify(self, event):
+        with self._lock:
+            action = event['action']
+            self.action_counts[action] = self.action_counts.get(action, 0) + 1
+            if event['kind'] == pysvn.node_kind.file:
+                self.files += 1
+
+            if self.per_file:
+                svn_notification_callback(self.abs_base_path, event)
+            elif self.live:
+                self._refresh()
+
+    def progress(self, progress, total):
+        # progress is cumulative per RA session, and restarts with each new one
+        with self._lock:
+            if progress < self._session_bytes:
+                self._session_bytes = 0
+            self.bytes += progress - self._session_bytes
+            self._session_bytes = progress
+            if self.live:
+                self._refresh()
+
+    def _refresh(self):
+        now = time.time()
+        if now - self._last_refresh < self.interval:
+            return
+        self._last_refresh = now
+
+        elapsed = max(now - self._start, 0.001)
+        sys.stdout.write('\r[%s] %d files (%.0f/s), %s (%s/s)    ' % (
+            self._phase or 'working', self.files, self.files / elapsed,
+            format_bytes(self.bytes), format_bytes(self.bytes / elapsed)))
+        sys.stdout.flush()
+
+    def start_phase(self, name):
+        if name == self._phase:
+            return
+        self.end_phase()
+        self._phase = name
+        self._phase_start = time.time()
+
+    def end_phase(self):
+        if self._phase is None:
+            return
+
+        elapsed = time.time() - self._phase_start
+        for phase in self.phase_times:
+            if phase[0] == self._phase:
+                phase[1] += elapsed
+                break
+        else:
+            self.phase_times.append([self._phase, elapsed])
+        self._phase = None
+
+    def summary(self):
+        self.end_phase()
+        elapsed = max(time.time() - self._start, 0.001)
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+        return {
+            'elapsed': elapsed,
+            'peak_rss': peak_rss, # As reported by getrusage (KB on linux)
+            'files': self.files,
+            'bytes': self.bytes,
+            'files_per_sec': self.files / elapsed,
+            'bytes_per_sec': self.bytes / elapsed,
+            'actions': dict((str(k), v) for (k, v) in self.action_counts.iteritems()),
+            'phases': [ { 'name': name, 'elapsed': t } for (name, t) in self.phase_times ] }
+
+    def finish(self, json_filename=None):
+        summary = self.summary()
+        if self.live and self._last_refresh:
+            print
+
+        print 'Finished in %.1fs: %d files (%.0f/s), %s (%s/s)' % (
+            summary['elapsed'], summary['files'], summary['files_per_sec'],
+            format_bytes(summary['bytes']), format_bytes(summary['bytes_per_sec']))
+        for phase in summary['phases']:
+            print '  %-18s %.1fs' % (phase['name'], phase['elapsed'])
+        for action, count in sorted(summary['actions'].iteritems()):
+            print '  %-18s %d' % (action, count)
+
+        if json_filename:
+            json.dump(summary, open(json_filename, 'w'), indent=2, sort_keys=True)
+
+
+def parse_conf_file(filename, _included=None):
     def _strip_line(l):
         if '#' in l:
             l = l[:l.index('#')]
         return l.strip()
 
-    absfilename = os.path.join( os.path.dirname( __file__ ), filename )
+    absfilename = os.path.normpath(os.path.join( os.path.dirname( __file__ ), filename ))
+
+    # Each profile is only pulled in once, which also guards against cycles
+    if _included is None:
+        _included = set()
+    if absfilename in _included:
+        return [], []
+    _included.add(absfilename)
 
     inclusions = []
     exclusions = []
@@ -78,23 +280,523 @@ def parse_conf_file(filename):
             exclusions.append(line[1:].strip())
         elif line.startswith('+'):
             inclusions.append(line[1:].strip())
+        elif line.startswith('%include'):
+            include_filename = line[len('%include'):].strip()
+            if '.conf' not in include_filename:
+                include_filename = include_filename + '.conf'
+            include_filename = os.path.join(os.path.dirname(absfilename), include_filename)
+            included_exclusions, included_inclusions = parse_conf_file(include_filename, _included)
+            exclusions.extend(included_exclusions)
+            inclusions.extend(included_inclusions)
 
     return exclusions, inclusions
 
 
+def is_glob(path_part):
+    return any(c in path_part for c in GLOB_CHARS)
+
+
+def split_profile_path(path):
+    return [ x for x in path.split('/') if x ]
+
+
+def glob_root(path):
+    # Literal folder above the first glob segment of a profile path: '/a/*/b' -> '/a'
+    parts = path.split('/')
+    for i, part in enumerate(parts):
+        if is_glob(part):
+            return '/'.join(parts[:i])
+    return path
+
+
+def unique_paths(paths):
+    # Drops repeated paths, keeping the order they were first seen in
+    seen = set()
+    return [ x for x in paths if not (x in seen or seen.add(x)) ]
+
+
+def compile_glob(pattern):
+    # Only '*' is special, so names containing '?', '[' or ']' can be used as they are
+    return re.compile('.*'.join(re.escape(x) for x in pattern.split('*')) + r'\Z', re.DOTALL)
+
+
+class ProfileError(Exception):
+    pass
+
+
+class _ProfileNode(object):
+    __slots__ = ('children', 'globs', 'globstar', 'rule', 'states_below')
+
+    def __init__(self, globstar=False):
+        self.children = {}      # literal segment -> node
+        self.globs = []         # (pattern, compiled pattern, node)
+        self.globstar = globstar
+        self.rule = None        # (order, EXCLUDED/INCLUDED, profile path)
+        self.states_below = set() # States of all rules further down the trie
+
+
+class SparseProfile(object):
+    """
+    Compiled form of a profile's exclusions and inclusions: a trie over path
+    segments. Segments may contain '*' globs, and '**' matches any number of
+    folders. The deepest matching rule applies to a path, and inclusions win
+    over exclusions at the same depth. For literal rules, classify() and
+    rule() run in O(depth) regardless of profile size.
+    """
+    def __init__(self, exclusions, inclusions):
+        self.root = _ProfileNode()
+
+        order = 0
+        for state, paths in ((EXCLUDED, exclusions), (INCLUDED, inclusions)):
+            for path in paths:
+                self._add(path, (order, state, path))
+                order += 1
+
+    def _add(self, path, rule):
+        node = self.root
+        parents = []
+        for part in split_profile_path(path):
+            parents.append(node)
+            if is_glob(part):
+                for pattern, regex, child in node.globs:
+                    if pattern == part:
+                        break
+                else:
+                    child = _ProfileNode(globstar=(part == '**'))
+                    node.globs.append((part, compile_glob(part), child))
+            else:
+                child = node.children.get(part)
+                if child is None:
+                    child = node.children[part] = _ProfileNode()
+            node = child
+
+        node.rule = rule
+        for parent in parents:
+            parent.states_below.add(rule[1])
+
+    def _with_globstars(self, nodes):
+        # '**' can match zero folders, so its node is also active alongside its parent
+        result = []
+        seen = set()
+        while nodes:
+            node = nodes.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            result.append(node)
+            nodes.extend(child for (pattern, regex, child) in node.globs if child.globstar)
+        return result
+
+    def _match(self, path):
+        # Returns the deciding rule, whether it matched the last segment of
+        # path itself, and the trie nodes still active below path
+        best = None
+        here = False
+        active = self._with_globstars([self.root])
+        for part in split_profile_path(path):
+            matched = []
+            for node in active:
+                child = node.children.get(part)
+                if child is not None:
+                    matched.append(child)
+                for pattern, regex, child in node.globs:
+                    if not child.globstar and regex.match(part):
+                        matched.append(child)
+                if node.globstar:
+                    matched.append(node)
+
+            active = self._with_globstars(matched)
+            rules = [ x.rule for x in active if x.rule is not None ]
+            here = bool(rules)
+            if rules:
+                best = max(rules)
+            if not active:
+                break
+
+        return best, here, active
+
+    def classify(self, path, is_dir=True):
+        """Returns EXCLUDED, INCLUDED or PARTIAL (folders only) for the given path."""
+        best, here, active = self._match(path)
+        state = best[1] if best is not None else INCLUDED
+        if is_dir and any(x.states_below - set([state]) for x in active):
+            return PARTIAL
+        return state
+
+    def matching_rule(self, path):
+        # Returns the profile path of the rule deciding path, if that rule
+        # names path itself rather than one of the folders above it
+        best, here, active = self._match(path)
+        return best[2] if here else None
+
+    def rule(self, path):
+        # Returns EXCLUDED/INCLUDED if a literal rule is defined for exactly this path
+        node = self.root
+        for part in split_profile_path(path):
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node.rule[1] if node.rule is not None else None
+
+
+def get_user_cache_dir():
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'svn_tools')
+
+
+class LsDiskCache(object):
+    """
+    Persistent cache of svn ls results, keyed by (repository UUID, url, revision).
+    A listing at a fixed revision never changes, so entries never need to be
+    invalidated, only evicted (least recently used first) once the cache grows
+    beyond max_size bytes. Backed by sqlite, which takes care of locking
+    between concurrent runs. New entries and usage times are buffered in
+    memory and written in a single transaction on flush().
+    """
+    def __init__(self, filename, repos_uuid, max_size=DEFAULT_LS_CACHE_SIZE):
+        self.repos_uuid = repos_uuid
+        self.max_size = max_size
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._used = set()
+        self._missed = set()
+
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        self._db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute('CREATE TABLE IF NOT EXISTS ls ('
+                         'uuid TEXT, url TEXT, revision INTEGER, dirs TEXT, files TEXT, '
+                         'size INTEGER, last_used REAL, PRIMARY KEY (uuid, url, revision))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS ls_last_used ON ls (last_used)')
+        self._db.commit()
+
+    def get(self, url, revnum):
+        with self._lock:
+            row = self._db.execute('SELECT dirs, files FROM ls WHERE uuid=? AND url=? AND revision=?',
+                                   (self.repos_uuid, url, revnum)).fetchone()
+            if row is None:
+                # Misses get probed again before and after they're listed, so count each once
+                self._missed.add((url, revnum))
+                return None
+
+            self.hits += 1
+            self._used.add((url, revnum))
+            return _split_names(row[0]), _split_names(row[1])
+
+    @property
+    def misses(self):
+        return len(self._missed)
+
+    def put(self, url, revnum, dirs, files):
+        with self._lock:
+            self._pending[(url, revnum)] = ('\n'.join(dirs), '\n'.join(files))
+
+    def flush(self):
+        with self._lock:
+            now = time.time()
+            with self._db:
+                for (url, revnum), (dirs, files) in self._pending.iteritems():
+                    self._db.execute('INSERT OR REPLACE INTO ls VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     (self.repos_uuid, url, revnum, dirs, files,
+                                      len(url) + len(dirs) + len(files), now))
+                self._db.executemany('UPDATE ls SET last_used=? WHERE uuid=? AND url=? AND revision=?',
+                                     [ (now, self.repos_uuid, url, revnum) for (url, revnum) in self._used ])
+                self._evict()
+            self._pending = {}
+            self._used = set()
+
+    def _evict(self):
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM ls').fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        stale = []
+        for rowid, size in self._db.execute('SELECT rowid, size FROM ls ORDER BY last_used'):
+            if total <= self.max_size:
+                break
+            stale.append((rowid,))
+            total -= size
+        self._db.executemany('DELETE FROM ls WHERE rowid=?', stale)
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+def _split_names(s):
+    return s.split('\n') if s else []
+
+
+def open_ls_disk_cache(repos_uuid, verbose):
+    filename = os.path.join(get_user_cache_dir(), 'ls_cache.db')
+    try:
+        return LsDiskCache(filename, repos_uuid)
+    except (EnvironmentError, sqlite3.Error) as e:
+        if verbose:
+            print 'WARNING: ls cache unavailable (%s): %s' % (filename, e)
+        return None
+
+
 _LS_CACHE = {}
-def svn_ls(svn_client, url, revision):
+_LS_DISK_CACHE = None
+def _cached_ls(url, revision):
     if url in _LS_CACHE:
         return _LS_CACHE[url]
 
+    if _LS_DISK_CACHE is not None and revision.kind == pysvn.opt_revision_kind.number:
+        entry = _LS_DISK_CACHE.get(url, revision.number)
+        if entry is not None:
+            _LS_CACHE[url] = entry
+            return entry
+
+    return None
+
+
+def _store_ls(url, revision, dirs, files):
+    _LS_CACHE[url] = (dirs, files)
+    if _LS_DISK_CACHE is not None and revision.kind == pysvn.opt_revision_kind.number:
+        _LS_DISK_CACHE.put(url, revision.number, dirs, files)
+
+
+def svn_ls(svn_client, url, revision):
+    entry = _cached_ls(url, revision)
+    if entry is not None:
+        return entry
+
     res = svn_client.ls(url, revision=revision)
     url_len = len(url) # name includes full url, remove this prefix
     dirs = [ x.name[url_len:] for x in res if x.kind == pysvn.node_kind.dir ]
     files = [ x.name[url_len:] for x in res if x.kind == pysvn.node_kind.file ]
-    _LS_CACHE[url] = (dirs, files)
+    _store_ls(url, revision, dirs, files)
     return dirs, files
 
 
+def svn_ls_recursive(svn_client, url, revision):
+    # Yields (path, is_dir) for everything below url, with paths relative to url
+    res = svn_client.list(url, revision=revision, recurse=True, dirent_fields=pysvn.SVN_DIRENT_KIND)
+    url_len = len(url.rstrip('/'))
+    for entry, lock in res:
+        path = entry.path[url_len:]
+        if path.strip('/'):
+            yield path, entry.kind == pysvn.node_kind.dir
+
+
+def walk_profile(svn_client, url, profile, roots, revision, jobs):
+    """
+    Plans the folders below roots (such as the literal folder above a glob
+    rule) by classifying every listed child with the profile. Only folders
+    which the profile leaves partially included are listed, a level at a time.
+    Yields (path, state): PARTIAL folders to keep sparse (before their
+    contents), EXCLUDED folders which a rule names, and INCLUDED paths to
+    fetch in full. Glob rules must only match folders.
+    """
+    level = [ x for x in roots if profile.classify(x) == PARTIAL ]
+    seen = set(level)
+    while level:
+        if jobs > 1:
+            prefetch_ls([ url + x + '/' for x in level ], revision, jobs)
+
+        next_level = []
+        for path in level:
+            dirs, files = svn_ls(svn_client, url + path + '/', revision)
+            for name in dirs:
+                full_path = path + '/' + name
+                if full_path in seen:
+                    continue
+                seen.add(full_path)
+
+                state = profile.classify(full_path)
+                if state == PARTIAL:
+                    next_level.append(full_path)
+                elif state == EXCLUDED and profile.matching_rule(full_path) is None:
+                    continue # Below an excluded folder
+                yield full_path, state
+
+            for name in files:
+                full_path = path + '/' + name
+                rule = profile.matching_rule(full_path)
+                if rule is not None and is_glob(rule):
+                    raise ProfileError('glob rule %s matches file %s, glob rules must only match folders' % (rule[1:], full_path[1:]))
+                if profile.classify(full_path, is_dir=False) == INCLUDED:
+                    yield full_path, INCLUDED
+
+        level = next_level
+
+
+class PathTrie(object):
+    """
+    Compact in-memory index of a recursive listing. Nodes are kept in
+    pre-order in flat arrays, so the subtree of node i occupies the index
+    range [i, end[i]) and its children can be walked by skipping from one
+    subtree end to the next. Path segments are interned, so a name which
+    repeats across the tree (src, include, Debug, ...) is only stored once.
+    """
+    def __init__(self, entries):
+        self._segment_ids = {}
+        self._segments = []
+        self._seg = array('l', [-1]) # Node 0 is the listed root
+        self._end = array('l', [0])
+        self._is_dir = array('b', [1])
+
+        # svn list -R gives entries in pre-order (each folder's entries sorted,
+        # and followed by their own), so the tree is built as they stream in
+        # without holding them all. Anything out of order is skipped as unlisted.
+        stack = [0]
+        stack_parts = []
+        for path, is_dir in entries:
+            parts = path.strip('/').split('/')
+            while len(stack) > len(parts):
+                self._end[stack.pop()] = len(self._seg)
+                stack_parts.pop()
+            if stack_parts != parts[:-1]:
+                continue # Parent wasn't listed
+
+            node = len(self._seg)
+            self._seg.append(self._intern(parts[-1]))
+            self._end.append(0)
+            self._is_dir.append(1 if is_dir else 0)
+            stack.append(node)
+            stack_parts.append(parts[-1])
+
+        while stack:
+            self._end[stack.pop()] = len(self._seg)
+
+    def __len__(self):
+        return len(self._seg) - 1
+
+    def _intern(self, name):
+        seg = self._segment_ids.get(name)
+        if seg is None:
+            seg = len(self._segments)
+            self._segment_ids[name] = seg
+            self._segments.append(name)
+        return seg
+
+    def _children(self, node):
+        child = node + 1
+        end = self._end[node]
+        while child < end:
+            yield child
+            child = self._end[child]
+
+    def _find(self, path):
+        node = 0
+        path = path.strip('/')
+        for part in (path.split('/') if path else []):
+            seg = self._segment_ids.get(part)
+            if seg is None:
+                return None
+            for child in self._children(node):
+                if self._seg[child] == seg:
+                    node = child
+                    break
+            else:
+                return None
+        return node
+
+    def listdir(self, path):
+        """Returns (dirs, files) below path, the same as svn_ls, or None if path isn't a listed folder."""
+        node = self._find(path)
+        if node is None or not self._is_dir[node]:
+            return None
+
+        dirs = []
+        files = []
+        for child in self._children(node):
+            (dirs if self._is_dir[child] else files).append(self._segments[self._seg[child]])
+        return dirs, files
+
+
+def plan_bulk_listings(ancestors, planner):
+    """
+    Chooses which sparse folders are discovered through a single recursive
+    listing of their top level folder rather than one svn ls each. Returns an
+    ordered list of (top level folder, [sparse folders below it]).
+    """
+    if planner == 'ls':
+        return []
+
+    groups = []
+    grouped = {}
+    for path in ancestors:
+        root = '/' + path.split('/')[1] + '/'
+        if root == '//':
+            continue # The checkout root itself is always listed directly
+
+        if root not in grouped:
+            grouped[root] = []
+            groups.append((root, grouped[root]))
+        grouped[root].append(path)
+
+    return [ (root, paths) for (root, paths) in groups
+             if planner == 'bulk' or len(paths) >= BULK_LS_THRESHOLD ]
+
+
+def prefetch_ls_bulk(svn_client, url, root, paths, revision, verbose):
+    # Populates _LS_CACHE for every path below root from one recursive listing
+    trie = PathTrie(svn_ls_recursive(svn_client, url + root, revision))
+    if verbose:
+        print 'Bulk listed %s: %d nodes for %d sparse folders' % (root, len(trie), len(paths))
+
+    for path in paths:
+        listing = trie.listdir(path[len(root):])
+        if listing is not None:
+            _store_ls(url + path, revision, *listing)
+
+
+_WORKER_STATE = threading.local()
+def _get_worker_client():
+    # pysvn clients aren't thread safe, so each worker thread gets its own
+    svn_client = getattr(_WORKER_STATE, 'svn_client', None)
+    if svn_client is None:
+        svn_client = create_svn_client()
+        _WORKER_STATE.svn_client = svn_client
+    return svn_client
+
+
+def _ls_worker(url, revision):
+    return svn_ls(_get_worker_client(), url, revision)
+
+
+def prefetch_ls(urls, revision, jobs):
+    """
+    Populates _LS_CACHE for all given urls using a bounded pool of worker
+    threads. Urls which are already cached in memory or on disk (or duplicated)
+    are only listed once.
+    """
+    pending = []
+    seen = set()
+    for url in urls:
+        if url not in seen and _cached_ls(url, revision) is None:
+            seen.add(url)
+            pending.append(url)
+
+    if not pending:
+        return
+
+    pool = ThreadPool(processes=min(jobs, len(pending)))
+    try:
+        pool.map_async(functools.partial(_ls_worker, revision=revision), pending).get(_POOL_TIMEOUT)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def create_svn_client():
+    svn_client = pysvn.Client()
+    svn_client.callback_ssl_server_trust_prompt = ssl_server_trust_prompt
+    svn_client.callback_get_login = get_login
+    svn_client.callback_cancel = svn_cancel_callback
+    svn_client.set_interactive(True)
+    return svn_client
+
+
 def pop_path(path):
     if not path:
         return path
@@ -109,39 +811,453 @@ def pop_path(path):
     return path[:idx+1] # Include trailing /
 
 
-def is_dir_empty(path):
-    return len(os.listdir(path)) == 0
-    
+def exclusion_ancestors(exclusions):
+    # Unique ancestor directories of the exclusions, in the order step 2 visits them
+    ancestors = []
+    seen = set()
+    for path in exclusions:
+        path = pop_path(path)
+        while path:
+            if path not in seen:
+                seen.add(path)
+                ancestors.append(path)
+            path = pop_path(path)
+    return ancestors
 
-def do_sparse_checkout(url, dest, exclusions, inclusions, dry_run, verbose):
-    svn_client = pysvn.Client()
-    svn_client.callback_ssl_server_trust_prompt = ssl_server_trust_prompt
-    svn_client.callback_get_login = get_login
-    #svn_client.callback_cancel = svn_cancel_callback
-    svn_client.set_interactive(True)
 
-    if verbose:
-        svn_client.callback_notify = functools.partial(svn_notification_callback, os.path.abspath(dest))
+def path_ancestors(path):
+    # '/a/b/c' -> '/a', '/a/b', '/a/b/c'
+    full_path = ''
+    for path_part in path.split('/')[1:]:
+        full_path = full_path + '/' + path_part
+        yield full_path
+
+
+def get_wc_admin_filename(dest, name):
+    return os.path.join(dest, '.svn', name)
+
+
+def read_wc_pickle(dest, name):
+    try:
+        return pickle.loads(open(get_wc_admin_filename(dest, name), 'rb').read())
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+
+
+def write_wc_pickle(dest, name, value):
+    filename = get_wc_admin_filename(dest, name)
+    temp_filename = filename + '.tmp'
+    open(temp_filename, 'wb').write(pickle.dumps(value))
+    if os.path.exists(filename):
+        os.remove(filename) # os.rename won't replace on windows
+    os.rename(temp_filename, filename)
+
+
+def read_sparse_state(dest):
+    return read_wc_pickle(dest, SPARSE_STATE_FILENAME)
+
+
+def write_sparse_state(dest, state):
+    write_wc_pickle(dest, SPARSE_STATE_FILENAME, state)
 
-    # Exclusions/inclusions must start with a /. 
-    filtered_exclusions = [ '/' + x for x in exclusions ]
-    filtered_inclusions = [ '/' + x for x in inclusions ]
+
+def read_journal(dest):
+    return read_wc_pickle(dest, SPARSE_JOURNAL_FILENAME)
+
+
+def write_journal(dest, journal):
+    write_wc_pickle(dest, SPARSE_JOURNAL_FILENAME, journal)
+
+
+def remove_journal(dest):
+    filename = get_wc_admin_filename(dest, SPARSE_JOURNAL_FILENAME)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def execute_journal(svn_client, dest, journal, dry_run, reporter):
+    """
+    Runs the planned update operations of a journal, starting from the first
+    one which hasn't completed yet. Progress is written back to the journal
+    after every operation, so an interrupted checkout can be resumed. Once
+    everything is done the applied profile is recorded and the journal removed.
+    """
+    revision = pysvn.Revision(pysvn.opt_revision_kind.number, journal['revision'])
+    operations = journal['operations']
+
+    for index in xrange(journal['done'], len(operations)):
+        if _SHOULD_CANCEL:
+            raise KeyboardInterrupt
+
+        depth, paths = operations[index]
+        paths = [ dest + x for x in paths ]
+        reporter.start_phase(UPDATE_PHASES[depth])
+        if dry_run:
+            print ('svn up' if depth == 'unknown' else 'svn up --set-depth=' + depth), ' '.join(paths)
+            continue
+
+        svn_depth, depth_is_sticky = UPDATE_DEPTHS[depth]
+        svn_client.update(paths, depth=svn_depth, depth_is_sticky=depth_is_sticky, revision=revision)
+        journal['done'] = index + 1
+        write_journal(dest, journal)
+
+    reporter.end_phase()
+
+    # Remember what was applied, so the next run only needs to apply a delta
+    if not dry_run:
+        write_sparse_state(dest, {
+            'url': journal['url'],
+            'revision': journal['revision'],
+            'exclusions': journal['exclusions'],
+            'inclusions': journal['inclusions'] })
+        remove_journal(dest)
+
+
+def get_changed_paths(svn_client, url, repos_root_url, old_revnum, target_revision):
+    # Returns [ (action, path, copied) ] for changes below url after old_revnum, oldest first
+    url_prefix = urllib.unquote(url[len(repos_root_url):])
+    start_revision = pysvn.Revision(pysvn.opt_revision_kind.number, old_revnum + 1)
+    log = svn_client.log(url, revision_start=start_revision, revision_end=target_revision,
+                         discover_changed_paths=True)
+
+    changes = []
+    for entry in log:
+        for changed in entry.changed_paths:
+            if changed.path.startswith(url_prefix + '/'):
+                changes.append((changed.action, changed.path[len(url_prefix):], changed.copyfrom_path is not None))
+    return changes
+
+
+def discover_added_siblings(svn_client, url, repos_root_url, old_revnum, target_revision, ancestors):
+    """
+    Uses the changed paths log between the previously applied revision and
+    the target revision to find nodes added directly below sparse ancestors.
+    These sit under depth=empty folders, so updating the working copy won't
+    bring them in by itself.
+    """
+    added = {} # path -> order first seen
+    for action, path, copied in get_changed_paths(svn_client, url, repos_root_url, old_revnum, target_revision):
+        if action in ('A', 'R') and pop_path(path) in ancestors:
+            added.setdefault(path, len(added))
+        elif action == 'D':
+            added.pop(path, None)
+
+    return sorted(added, key=added.get)
+
+
+class DestSnapshot(object):
+    """
+    Snapshot of the destination folders which are relevant to a profile, so
+    planning can answer existence and emptiness questions without stat'ing
+    the same paths over and over (each of which is expensive on network or
+    virus scanned drives). Each folder is listed at most once, and emptiness
+    of folders outside the snapshot stops scanning at the first entry.
+    Paths are relative to dest, in the planner's '/a/b' form.
+    """
+    def __init__(self, dest, dirs):
+        self.dest = dest
+        self.syscalls = 0   # Filesystem calls actually made
+        self.queries = 0    # Filesystem calls the questions asked would have cost
+        self._listings = {} # dir -> { normcased name: is_dir (None if not yet known) } or None if missing
+        self._empty = {}
+
+        self._root_exists = os.path.isdir(dest)
+        self.syscalls += 1
+
+        # Parents sort before their children, so missing subtrees are never scanned
+        for path in sorted(dirs):
+            self._listing(path)
+
+    def _scan(self, path):
+        self.syscalls += 1
+        try:
+            if scandir is not None:
+                return dict((os.path.normcase(x.name), x.is_dir()) for x in scandir(self.dest + path))
+            return dict((os.path.normcase(x), None) for x in os.listdir(self.dest + path))
+        except OSError:
+            return None
+
+    def _listing(self, path):
+        if path not in self._listings:
+            if path == '':
+                self._listings[path] = self._scan(path) if self._root_exists else None
+            else:
+                parent, name = path.rsplit('/', 1)
+                self._listings[path] = self._scan(path) if self._isdir(parent, name) else None
+        return self._listings[path]
+
+    def _isdir(self, parent, name):
+        listing = self._listing(parent)
+        name = os.path.normcase(name)
+        if listing is None or name not in listing:
+            return False
+
+        if listing[name] is None:
+            self.syscalls += 1
+            listing[name] = os.path.isdir(self.dest + parent + '/' + name)
+        return listing[name]
+
+    def exists(self, path):
+        self.queries += 1
+        if path == '':
+            return self._root_exists
+
+        parent, name = path.rsplit('/', 1)
+        listing = self._listing(parent)
+        return listing is not None and os.path.normcase(name) in listing
+
+    def isdir(self, path):
+        self.queries += 1
+        if path == '':
+            return self._root_exists
+        return self._isdir(*path.rsplit('/', 1))
+
+    def is_empty(self, path):
+        self.queries += 1
+        if path in self._listings:
+            return not self._listings[path]
+
+        if path not in self._empty:
+            self.syscalls += 1
+            if scandir is not None:
+                self._empty[path] = next(iter(scandir(self.dest + path)), None) is None
+            else:
+                self._empty[path] = len(os.listdir(self.dest + path)) == 0
+        return self._empty[path]
+
+
+def batch_updates(paths, max_batch=MAX_UPDATE_BATCH):
+    """
+    Groups update targets into batches which can each be passed to a single
+    svn update call. Paths are grouped by their depth in the tree, shallowest
+    first, so parents are always materialised before their children. Within
+    a level the original ordering is preserved.
+    """
+    levels = {}
+    for path in paths:
+        levels.setdefault(path.rstrip('/').count('/'), []).append(path)
+
+    batches = []
+    for level in sorted(levels.keys()):
+        level_paths = levels[level]
+        for i in xrange(0, len(level_paths), max_batch):
+            batches.append(level_paths[i:i+max_batch])
+    return batches
+
+
+def link_or_copy(src, dst):
+    try:
+        _hardlink(src, dst)
+    except OSError: # e.g. different volumes
+        shutil.copy2(src, dst)
+
+
+# Local changes which are reverted in a working copy seeded from a reference
+_LOCAL_CHANGE_STATUSES = set([
+    pysvn.wc_status_kind.modified,
+    pysvn.wc_status_kind.added,
+    pysvn.wc_status_kind.deleted,
+    pysvn.wc_status_kind.replaced,
+    pysvn.wc_status_kind.missing,
+    pysvn.wc_status_kind.conflicted,
+    pysvn.wc_status_kind.merged ])
+
+_NOT_COPIED_STATUSES = set([
+    pysvn.wc_status_kind.unversioned,
+    pysvn.wc_status_kind.ignored,
+    pysvn.wc_status_kind.added ])
+
+
+def seed_from_reference(svn_client, reference, url, dest, verbose):
+    """
+    Creates dest as a copy of an existing local working copy, so only the
+    difference to the target revision and profile needs to come over the
+    network. The pristine store is content addressed and never modified in
+    place, so it is hardlinked where possible; everything else is copied.
+    Unversioned and ignored files (e.g. build output) are left behind, and
+    local modifications are reverted in the copy.
+    """
+    ref_info = svn_client.info2(reference, recurse=False)[0][1]
+    url_info = svn_client.info2(url, recurse=False)[0][1]
+    if ref_info.repos_UUID != url_info.repos_UUID:
+        raise pysvn.ClientError('%s is not a working copy of the same repository as %s' % (reference, url))
+    if ref_info.URL[len(ref_info.repos_root_URL):] != url[len(url_info.repos_root_URL):]:
+        raise pysvn.ClientError('%s is a working copy of %s, not %s' % (reference, ref_info.URL, url))
+
+    skipped = set()
+    changed = []
+    for status in svn_client.status(reference, recurse=True, get_all=False, ignore=True, ignore_externals=True):
+        if status.text_status in _NOT_COPIED_STATUSES:
+            skipped.add(os.path.normcase(os.path.abspath(status.path)))
+        if status.text_status in _LOCAL_CHANGE_STATUSES or status.prop_status in _LOCAL_CHANGE_STATUSES:
+            changed.append(os.path.relpath(status.path, reference))
+
+    # Reverts are recursive, since an added folder can't be reverted without
+    # its added children, so anything below another reverted path is covered
+    changed.sort()
+    reverts = []
+    for path in changed:
+        if not reverts or not path.startswith(reverts[-1] + os.sep):
+            reverts.append(path)
+
+    reference = os.path.abspath(reference)
+    pristine_dir = os.path.join(reference, '.svn', 'pristine')
+    linked = copied = 0
+    try:
+        for root, dirs, files in os.walk(reference):
+            rel_root = os.path.relpath(root, reference)
+            dirs[:] = [ x for x in dirs if os.path.normcase(os.path.join(root, x)) not in skipped ]
+            os.makedirs(os.path.normpath(os.path.join(dest, rel_root)))
+
+            if root == os.path.join(reference, '.svn', 'tmp'):
+                continue
+
+            for name in files:
+                src = os.path.join(root, name)
+                if os.path.normcase(src) in skipped or name in (SPARSE_JOURNAL_FILENAME, 'wc.db-journal'):
+                    continue
+
+                dst = os.path.normpath(os.path.join(dest, rel_root, name))
+                if root.startswith(pristine_dir):
+                    link_or_copy(src, dst)
+                    linked += 1
+                else:
+                    shutil.copy2(src, dst)
+                    copied += 1
+
+        if verbose:
+            print 'Seeded %s from %s: %d pristine files linked, %d files copied' % (dest, reference, linked, copied)
+
+        svn_client.cleanup(dest)
+        if reverts:
+            svn_client.revert([ os.path.join(dest, x) for x in reverts ], recurse=True)
+
+        # Different server alias for the same repository
+        if ref_info.repos_root_URL != url_info.repos_root_URL:
+            svn_client.relocate(ref_info.repos_root_URL, url_info.repos_root_URL, dest, recurse=True)
+
+        # The copied profile state still applies, just under the new url
+        state = read_sparse_state(dest)
+        if state is not None:
+            state['url'] = url
+            write_sparse_state(dest, state)
+    except:
+        # A half seeded copy would be mistaken for a working copy by the next run
+        shutil.rmtree(dest, ignore_errors=True)
+        raise
+
+
+def do_sparse_checkout(url, dest, exclusions, inclusions, dry_run, verbose, jobs=DEFAULT_LS_JOBS, ls_cache=True, full=False, planner='auto', resume=False, reporter=None, reference=None):
+    global _LS_DISK_CACHE
+    svn_client = create_svn_client()
+
+    if reporter is None:
+        reporter = ProgressReporter(os.path.abspath(dest), verbose)
+    svn_client.callback_notify = reporter.notify
+    if hasattr(svn_client, 'callback_progress'): # Only in newer pysvn builds
+        svn_client.callback_progress = reporter.progress
+
+    # Start from a local copy of another working copy, rather than the network
+    if reference and not os.path.exists(dest):
+        reporter.start_phase('reference copy')
+        if dry_run:
+            print 'copy', reference, dest
+        else:
+            seed_from_reference(svn_client, reference, url, dest, verbose)
+
+    # Carry on with the plan of an interrupted run, skipping discovery entirely
+    journal = read_journal(dest) if os.path.exists(dest) else None
+    if journal is not None and journal['url'] != url:
+        journal = None
+
+    if resume:
+        if journal is not None:
+            print 'Resuming checkout of r%d: %d of %d operations already complete' % (
+                journal['revision'], journal['done'], len(journal['operations']))
+            execute_journal(svn_client, dest, journal, dry_run, reporter)
+            return
+        print 'No interrupted checkout found to resume, starting a new one.'
+    elif journal is not None:
+        print 'NOTE: replanning an interrupted checkout (use --resume to continue it instead).'
 
     svn_up_empty = []
     svn_up_infinite = []
+    svn_up_exclude = []
+
+    reporter.start_phase('info')
 
     # 0. Determine revision we are updating to
     svn_info = svn_client.info2(url, recurse=False)
     target_revision = svn_info[0][1].rev
 
+    reporter.start_phase('discovery')
+
+    if ls_cache:
+        _LS_DISK_CACHE = open_ls_disk_cache(svn_info[0][1].repos_UUID, verbose)
+
+    # Exclusions/inclusions must start with a /. 
+    filtered_exclusions = [ '/' + x for x in exclusions ]
+    filtered_inclusions = [ '/' + x for x in inclusions ]
+    profile = SparseProfile(filtered_exclusions, filtered_inclusions)
+
+    # Glob rules are planned by walking down from the literal folder above
+    # them, which is kept sparse in the same way as an exclusion's parents
+    glob_rules = [ x for x in filtered_exclusions + filtered_inclusions if is_glob(x) ]
+    glob_roots = unique_paths(glob_root(x) for x in glob_rules)
+
+    # If this working copy already had a profile applied, only the difference
+    # between that profile and this one needs to be planned. Everything which
+    # is unchanged gets brought up to the target revision by a single update
+    # of the working copy root (which respects the existing sticky depths).
+    state = None
+    if not full and os.path.exists(dest):
+        state = read_sparse_state(dest)
+        if state is not None and state['url'] != url:
+            state = None
+
+    old_profile = None
+    if state is not None:
+        old_exclusions = set(state['exclusions'])
+        old_inclusions = set(state['inclusions'])
+        old_profile = SparseProfile(state['exclusions'], state['inclusions'])
+        changed_exclusions = [ x for x in filtered_exclusions if x not in old_exclusions ]
+        changed_inclusions = [ x for x in filtered_inclusions if x not in old_inclusions ]
+        removed_paths = sorted((old_exclusions - set(filtered_exclusions)) | (old_inclusions - set(filtered_inclusions)))
+        if verbose:
+            print 'Applying profile delta to r%d: %d exclusions added, %d inclusions added, %d entries removed' % (
+                target_revision.number, len(changed_exclusions), len(changed_inclusions), len(removed_paths))
+
+        # Glob folders are walked again if their rules changed, or anything
+        # below them may have been added since the profile was last applied
+        changed_roots = unique_paths(glob_root(x) for x in changed_exclusions + changed_inclusions + removed_paths if is_glob(x))
+        walk_roots = glob_roots if target_revision.number > state['revision'] else changed_roots
+        removed_paths = sorted(set(glob_root(x) for x in removed_paths))
+    else:
+        changed_exclusions = filtered_exclusions
+        changed_inclusions = filtered_inclusions
+        changed_roots = walk_roots = glob_roots
+        removed_paths = []
+
+    changed_exclusions = [ x for x in changed_exclusions if not is_glob(x) ]
+    changed_inclusions = [ x for x in changed_inclusions if not is_glob(x) ]
+    literal_rules = [ x for x in filtered_inclusions + filtered_exclusions if not is_glob(x) ]
+
+    # Everything planning needs to know about the destination comes from one
+    # snapshot of the folders which the profile touches
+    snapshot_dirs = set()
+    for path in literal_rules + glob_roots:
+        for full_path in path_ancestors(path):
+            snapshot_dirs.add(full_path.rsplit('/', 1)[0])
+    snapshot = DestSnapshot(dest, snapshot_dirs)
+
     # 1. Iterate up through the exclusion paths, checking out only empty.
     # Treat inclusions as exclusions at this point for convenience, as we
     # will need to make sure we have all the intermediate nodes available,
     # and we will do a proper update on inclusion leaf node later
     seen_exclusions = set()
-    for path in filtered_inclusions + filtered_exclusions:
+    for path in literal_rules + glob_roots:
         full_path = ''
-        is_inclusion = path in filtered_inclusions
+        is_exclusion = profile.rule(path) == EXCLUDED
         for path_part in path.split('/'):
             full_path = full_path + '/' + path_part if path_part != '' else ''
             if full_path in seen_exclusions:
@@ -150,20 +1266,30 @@ def do_sparse_checkout(url, dest, exclusions, inclusions, dry_run, verbose):
             seen_exclusions.add(full_path)
 
             is_leaf_path = (full_path == path)
-            full_dest_path = dest + full_path # full path on disk
 
             # Don't reclear intermediate paths if they don't already exist
             # (only need to update this folder on the first time through).
-            if not os.path.exists(full_dest_path):
-                svn_up_empty.append(full_dest_path)
-            elif is_leaf_path and not is_dir_empty(full_dest_path) and not is_inclusion:
-                svn_up_empty.append(full_dest_path) # Strip back existing                
+            if not snapshot.exists(full_path):
+                svn_up_empty.append(full_path)
+            elif is_leaf_path and not snapshot.is_empty(full_path) and is_exclusion:
+                svn_up_empty.append(full_path) # Strip back existing                
 
 
     # 2. Iterate back down through the exclusion tree, doing an svn ls to
-    # discover which paths we do actually want to checkout.
+    # discover which paths we do actually want to checkout. The listings are
+    # fetched concurrently up front, so the walk below is served from _LS_CACHE
+    # and produces exactly the same ordering as a serial walk.
+    # Folders with lots of sparse folders below them are cheaper to list
+    # recursively once, and plan from an in-memory index of that listing.
+    ancestors = [ x for x in exclusion_ancestors(changed_exclusions + changed_roots) if _cached_ls(url + x, target_revision) is None ]
+    for root, paths in plan_bulk_listings(ancestors, planner):
+        prefetch_ls_bulk(svn_client, url, root, paths, target_revision, verbose)
+
+    if jobs > 1:
+        prefetch_ls([ url + x for x in ancestors ], target_revision, jobs)
+
     seen_checkouts = set()
-    for path in filtered_exclusions:
+    for path in changed_exclusions + changed_roots:
         path = pop_path(path) # Skip leaves which need to remain empty
         while path:
             full_url = url + path
@@ -171,50 +1297,380 @@ def do_sparse_checkout(url, dest, exclusions, inclusions, dry_run, verbose):
             
             for subdir in (dirs + files):
                 full_path = path + subdir
-                full_dest_path = dest + full_path # full path on disk
                 if full_path in seen_exclusions or full_path in seen_checkouts:
                     continue
+                if profile.classify(full_path) != INCLUDED:
+                    continue # Left to the glob walk below
 
                 # If we already exist, then don't re-checkout. However if the folder is
                 # empty, it may be a previous exclusion (which currently have empty folders),
                 # so just in case, do an update at this location (TODO: maybe use sparse marker 
                 # files to make this explicit?)
-                if os.path.exists(full_dest_path) and not (os.path.isdir(full_dest_path) and is_dir_empty(full_dest_path)):
+                if snapshot.exists(full_path) and not (snapshot.isdir(full_path) and snapshot.is_empty(full_path)):
                     continue
                 
-                svn_up_infinite.append(dest + full_path)
+                svn_up_infinite.append(full_path)
                 seen_checkouts.add(full_path)
 
             path = pop_path(path)
 
+    for full_path, path_state in walk_profile(svn_client, url, profile, walk_roots, target_revision, jobs):
+        if full_path in seen_exclusions or full_path in seen_checkouts:
+            continue
+
+        if path_state == INCLUDED:
+            # Unless it was only sparse or excluded under the previous profile
+            if (snapshot.exists(full_path) and not (snapshot.isdir(full_path) and snapshot.is_empty(full_path)) and
+                    (old_profile is None or old_profile.classify(full_path) == INCLUDED)):
+                continue
+            svn_up_infinite.append(full_path)
+            seen_checkouts.add(full_path)
+        else:
+            seen_exclusions.add(full_path)
+            if not snapshot.exists(full_path):
+                svn_up_empty.append(full_path)
+            elif path_state == EXCLUDED and not snapshot.is_empty(full_path):
+                svn_up_empty.append(full_path) # Strip back existing
+
+    if verbose:
+        print 'Destination snapshot: %d filesystem calls made, %d without the snapshot' % (snapshot.syscalls, snapshot.queries)
+
+    if _LS_DISK_CACHE is not None:
+        _LS_DISK_CACHE.close()
+        if verbose:
+            print 'ls cache: %d hits, %d misses' % (_LS_DISK_CACHE.hits, _LS_DISK_CACHE.misses)
+        _LS_DISK_CACHE = None
+
+    if state is not None:
+        # Pick up anything added on the server below unchanged sparse folders
+        # since the profile was last applied.
+        if target_revision.number > state['revision']:
+            ancestors = set(exclusion_ancestors([ x for x in filtered_exclusions if not is_glob(x) ] + glob_roots))
+            for path in discover_added_siblings(svn_client, url, svn_info[0][1].repos_root_URL,
+                                                state['revision'], target_revision, ancestors):
+                if path in seen_exclusions or path in seen_checkouts:
+                    continue
+                svn_up_infinite.append(path)
+                seen_checkouts.add(path)
+
+        # Paths which are no longer mentioned by the profile either need to be
+        # fetched (no longer excluded) or trimmed (now covered by an exclusion).
+        # The topmost folder which is no longer a sparse node is the one to
+        # change, as everything above it is still handled by the profile.
+        for path in removed_paths:
+            for full_path in path_ancestors(path):
+                if full_path not in seen_exclusions:
+                    break
+            else:
+                continue # Still a sparse folder in the new profile
+
+            if full_path in seen_checkouts:
+                continue
+            seen_checkouts.add(full_path)
+
+            if profile.classify(full_path) == EXCLUDED:
+                svn_up_exclude.append(full_path)
+            elif not (full_path == path and path in old_inclusions):
+                svn_up_infinite.append(full_path)
+
     # 3. Go through and update explicit inclusions. We can simply do a
     # SVN up on the inlcusion paths, since we have the leaf path updated
     # to empty during the exclusion step.
-    for path in filtered_inclusions:
-        svn_up_infinite.append(dest + path)
+    for path in changed_inclusions:
+        svn_up_infinite.append(path)
 
 
     # 4. Populate the sparse folders
+    reporter.start_phase('checkout')
     if not os.path.exists(dest):  # TODO: check is a valid svn WC
         if dry_run:
             print 'svn co --non-recursive', url, dest
         else:
             svn_client.checkout(url, dest, recurse=False)
 
-    for path in svn_up_empty:
-        if dry_run:
-            print 'svn up --depth=empty', path
-        else:
-            svn_client.update(path, depth=pysvn.depth.empty, revision=target_revision )
+    # Updates are batched into multi-target calls, so each batch only pays
+    # once for the working copy lock and RA session setup. The plan is
+    # journaled before anything runs, so it can be picked up by --resume.
+    # Paths are kept relative to dest, which may be given relative to a
+    # different working directory when resuming.
+    operations = []
+    if state is not None:
+        operations.append(('unknown', ['']))
+    operations.extend(('exclude', x) for x in batch_updates(svn_up_exclude))
+    operations.extend(('empty', x) for x in batch_updates(svn_up_empty))
 
     # 5. Do actual non-sparse content updates
-    for path in svn_up_infinite:
-        if dry_run:
-            print 'svn up --set-depth=infinity', path
+    operations.extend(('infinity', x) for x in batch_updates(svn_up_infinite))
+
+    journal = {
+        'url': url,
+        'revision': target_revision.number,
+        'exclusions': filtered_exclusions,
+        'inclusions': filtered_inclusions,
+        'operations': operations,
+        'done': 0 }
+    if not dry_run:
+        write_journal(dest, journal)
+
+    execute_journal(svn_client, dest, journal, dry_run, reporter)
+
+
+def read_export_manifest(dest):
+    try:
+        return pickle.loads(open(os.path.join(dest, SPARSE_EXPORT_MANIFEST), 'rb').read())
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+
+
+def write_export_manifest(dest, manifest):
+    filename = os.path.join(dest, SPARSE_EXPORT_MANIFEST)
+    open(filename + '.tmp', 'wb').write(pickle.dumps(manifest))
+    if os.path.exists(filename):
+        os.remove(filename) # os.rename won't replace on windows
+    os.rename(filename + '.tmp', filename)
+
+
+def remove_dest_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _export_worker(src_url, dest_path, revision, notify, recursive):
+    svn_client = _get_worker_client()
+    svn_client.callback_notify = notify
+    if recursive:
+        remove_dest_path(dest_path) # Re-exports must not leave stale files behind
+        svn_client.export(src_url, dest_path, force=True, revision=revision)
+    else:
+        # Only the node itself, anything below it is planned separately
+        svn_client.export(src_url, dest_path, force=True, revision=revision, depth=pysvn.depth.empty)
+
+
+def _export_worker_args(args):
+    return _export_worker(*args)
+
+
+def plan_export_changes(changes, profile):
+    """
+    Maps the changed paths between two revisions onto an existing export.
+    Returns [ (path, op) ] with one operation per changed path: 'export' for
+    added or modified nodes (a folder on its own, without its contents),
+    'delete' for deleted ones, 'replace' to remove and export again the whole
+    subtree of replaced or copied nodes, and 'walk' for folders added below
+    sparse folders which the profile only partially includes.
+    """
+    pending = {}
+    order = []
+    for action, path, copied in changes:
+        if any(pending.get(x) in ('replace', 'walk') for x in path_ancestors(pop_path(path))):
+            continue # Planned again at the target revision in full
+
+        state = profile.classify(path)
+        if state == PARTIAL and action != 'D':
+            if profile.classify(path, is_dir=False) == INCLUDED and action == 'M':
+                state = INCLUDED # A file, or folder properties which exports don't carry
+            elif action == 'M':
+                continue
+        elif state == EXCLUDED:
+            continue
+
+        if action == 'D':
+            result = 'delete'
+        elif state == PARTIAL:
+            result = 'walk'
+        elif action == 'R' or copied or pending.get(path) == 'delete':
+            result = 'replace'
         else:
-            svn_client.update(path, depth=pysvn.depth.infinity, revision=target_revision )
+            result = 'export'
+
+        if path not in pending:
+            order.append(path)
+        pending[path] = result
+
+    # Anything planned below a deleted, replaced or walked node is either
+    # gone, or planned along with it
+    return [ (x, pending[x]) for x in order
+             if not any(pending.get(y) in ('delete', 'replace', 'walk') for y in path_ancestors(pop_path(x))) ]
 
 
+def do_sparse_export(url, dest, exclusions, inclusions, dry_run, verbose, jobs=DEFAULT_LS_JOBS, ls_cache=True, full=False, planner='auto', reporter=None):
+    """
+    Applies a profile as a plain export rather than a working copy, which
+    avoids the pristine copies and wc.db bookkeeping on read-only machines.
+    Sparse folders are created empty, and every included subtree is exported
+    at the target revision by a pool of workers. A manifest in the export
+    root remembers what was exported, so a later run at a newer revision only
+    exports or removes the nodes which the log says have changed.
+    """
+    global _LS_DISK_CACHE
+    svn_client = create_svn_client()
+
+    if reporter is None:
+        reporter = ProgressReporter(os.path.abspath(dest), verbose)
+
+    reporter.start_phase('info')
+    svn_info = svn_client.info2(url, recurse=False)
+    target_revision = svn_info[0][1].rev
+
+    reporter.start_phase('discovery')
+    if ls_cache:
+        _LS_DISK_CACHE = open_ls_disk_cache(svn_info[0][1].repos_UUID, verbose)
+
+    filtered_exclusions = [ '/' + x for x in exclusions ]
+    filtered_inclusions = [ '/' + x for x in inclusions ]
+    profile = SparseProfile(filtered_exclusions, filtered_inclusions)
+
+    literal_exclusions = [ x for x in filtered_exclusions if not is_glob(x) ]
+    literal_inclusions = [ x for x in filtered_inclusions if not is_glob(x) ]
+    glob_roots = unique_paths(glob_root(x) for x in filtered_exclusions + filtered_inclusions if is_glob(x))
+
+    sparse_paths = []
+    seen = set()
+    for path in literal_inclusions + literal_exclusions + glob_roots:
+        for full_path in [''] + list(path_ancestors(path)):
+            if full_path not in seen:
+                seen.add(full_path)
+                sparse_paths.append(full_path)
+
+    ancestors = exclusion_ancestors(literal_exclusions + glob_roots)
+
+    previous_manifest = read_export_manifest(dest)
+    manifest = None if full else previous_manifest
+    if manifest is not None and (manifest['url'] != url or
+                                 manifest['exclusions'] != filtered_exclusions or
+                                 manifest['inclusions'] != filtered_inclusions):
+        print 'Profile or url changed since the last export, exporting everything again.'
+        manifest = None
+
+    if manifest is not None:
+        # Only what changed between the two revisions needs exporting again
+        changes = []
+        if target_revision.number > manifest['revision']:
+            changes = get_changed_paths(svn_client, url, svn_info[0][1].repos_root_URL,
+                                        manifest['revision'], target_revision)
+        planned = plan_export_changes(changes, profile)
+
+        # Nodes added below sparse folders which the profile only partially
+        # includes are either files, or folders planned like glob folders
+        operations = []
+        make_dirs = []
+        for path, op in planned:
+            if op == 'walk':
+                parent, name = path.rsplit('/', 1)
+                dirs, files = svn_ls(svn_client, url + parent + '/', target_revision)
+                if name in dirs:
+                    operations.append((path, 'delete'))
+                    make_dirs.append(path)
+                elif name in files and profile.classify(path, is_dir=False) == INCLUDED:
+                    operations.append((path, 'replace'))
+            else:
+                operations.append((path, op))
+
+        for path, path_state in walk_profile(svn_client, url, profile, make_dirs[:], target_revision, jobs):
+            if path_state == INCLUDED:
+                operations.append((path, 'replace'))
+            else:
+                make_dirs.append(path)
+
+        # The manifest lists the topmost exported nodes
+        deleted = set(x for (x, op) in operations if op == 'delete')
+        exported = [ x for x in manifest['exported'] if not any(y in deleted for y in path_ancestors(x)) ]
+        previous = set(exported)
+        exported.extend(x for (x, op) in operations if op in ('export', 'replace') and
+                        x not in previous and profile.classify(pop_path(x)) != INCLUDED)
+    else:
+        # Same discovery as a checkout, without anything to compare on disk
+        uncached = [ x for x in ancestors if _cached_ls(url + x, target_revision) is None ]
+        for root, paths in plan_bulk_listings(uncached, planner):
+            prefetch_ls_bulk(svn_client, url, root, paths, target_revision, verbose)
+        if jobs > 1:
+            prefetch_ls([ url + x for x in uncached ], target_revision, jobs)
+
+        exported = []
+        exported_set = set()
+        for path in ancestors:
+            dirs, files = svn_ls(svn_client, url + path, target_revision)
+            for name in (dirs + files):
+                full_path = path + name
+                if full_path not in seen and full_path not in exported_set and profile.classify(full_path) == INCLUDED:
+                    exported_set.add(full_path)
+                    exported.append(full_path)
+        for path in literal_inclusions:
+            if path not in exported_set:
+                exported_set.add(path)
+                exported.append(path)
+
+        make_dirs = sparse_paths
+        for path, path_state in walk_profile(svn_client, url, profile, glob_roots, target_revision, jobs):
+            if path in seen or path in exported_set:
+                continue
+            if path_state == INCLUDED:
+                exported_set.add(path)
+                exported.append(path)
+            else:
+                seen.add(path)
+                make_dirs.append(path)
+
+        # Whatever the last export put in place and this one doesn't export,
+        # including folders which are now sparse, must go first
+        operations = []
+        if previous_manifest is not None:
+            exported_set.update(exported)
+            operations.extend((x, 'delete') for x in previous_manifest['exported'] if x not in exported_set)
+        operations.extend((x, 'replace') for x in exported)
+
+    if _LS_DISK_CACHE is not None:
+        _LS_DISK_CACHE.close()
+        _LS_DISK_CACHE = None
+
+    if verbose:
+        print 'Export to r%d: %d subtrees and %d nodes to export, %d to remove' % (target_revision.number,
+            len([ x for x in operations if x[1] == 'replace' ]), len([ x for x in operations if x[1] == 'export' ]),
+            len([ x for x in operations if x[1] == 'delete' ]))
+
+    reporter.start_phase('export')
+    for path, op in operations:
+        if op == 'delete':
+            if dry_run:
+                print 'rm', dest + path
+            else:
+                remove_dest_path(dest + path)
+
+    for path in make_dirs:
+        if dry_run:
+            print 'mkdir', dest + path
+        elif not os.path.isdir(dest + path):
+            os.makedirs(dest + path)
+
+    exports = [ (url + x, dest + x, target_revision, reporter.notify, op == 'replace')
+                for (x, op) in operations if op in ('export', 'replace') ]
+    if dry_run:
+        for src_url, dest_path, revision, notify, recursive in exports:
+            print ('svn export' if recursive else 'svn export --depth=empty'), src_url, dest_path
+    elif exports:
+        for src_url, dest_path, revision, notify, recursive in exports:
+            if not os.path.isdir(os.path.dirname(dest_path)):
+                os.makedirs(os.path.dirname(dest_path))
+
+        pool = ThreadPool(processes=max(1, min(jobs, len(exports))))
+        try:
+            pool.map_async(_export_worker_args, exports).get(_POOL_TIMEOUT)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    reporter.end_phase()
+
+    if not dry_run:
+        write_export_manifest(dest, {
+            'url': url,
+            'revision': target_revision.number,
+            'exclusions': filtered_exclusions,
+            'inclusions': filtered_inclusions,
+            'exported': exported })
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Sparse SVN checkout')
@@ -222,7 +1678,15 @@ if __name__ == '__main__':
     parser.add_argument('path', type=str, nargs='?', help='Target path to checkout into.')
     parser.add_argument('-p', '--profile', default='', type=str, help='Sparse configuration profile.')
     parser.add_argument('-d', '--dry-run', default=False, action='store_true', help='Display SVN actions that would take place without actually performing them.')
-    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Display verbose information about operations performed.')
+    parser.add_argument('-v', '--verbose', default=0, action='count', help='Display verbose information about operations performed (-vv lists every updated path).')
+    parser.add_argument('--stats-json', default=None, type=str, help='Write progress counters and phase timings to this JSON file.')
+    parser.add_argument('-e', '--export', default=False, action='store_true', help='Export the profile as plain files instead of a working copy (for read-only build machines).')
+    parser.add_argument('--reference', default=None, type=str, metavar='WC', help='Seed a new checkout from an existing local working copy of the same url, then only update the difference.')
+    parser.add_argument('-r', '--resume', default=False, action='store_true', help='Continue an interrupted checkout from its journal, without replanning.')
+    parser.add_argument('-f', '--full', default=False, action='store_true', help='Ignore the previously applied profile and replan the whole working copy.')
+    parser.add_argument('--planner', default='auto', choices=PLANNER_MODES, help='How sparse folders are discovered: one svn ls per folder, one recursive listing per top level folder, or chosen automatically (default).')
+    parser.add_argument('--no-ls-cache', default=False, action='store_true', help='Don\'t read or write the persistent svn ls cache.')
+    parser.add_argument('-j', '--jobs', default=DEFAULT_LS_JOBS, type=int, help='Number of concurrent svn ls requests used while discovering paths (1 = serial).')
 
     args = parser.parse_args()
 
@@ -233,7 +1697,15 @@ if __name__ == '__main__':
         print 'ERROR: --profile not set'
         sys.exit(-1) ## TODO: support default action
 
-    if args.path is None:
+    if args.path is None and args.export:
+        # Re-export into an existing export
+        manifest = read_export_manifest(args.url)
+        if manifest is None:
+            print 'ERROR: %s is not an existing export.' % args.url
+            sys.exit(1)
+        args.path = args.url
+        args.url = manifest['url']
+    elif args.path is None:
         # Treat URL as path, and try to determine a URL
         try:
             existing_url = pysvn.Client().info( args.url ).url
@@ -249,14 +1721,33 @@ if __name__ == '__main__':
         print 'ERROR: failed to parse %s' % (args.profile,)
         sys.exit(-1)
 
+    signal.signal(signal.SIGINT, _sigint_handler)
+    reporter = ProgressReporter(os.path.abspath(args.path), args.verbose)
+
     try:
-        do_sparse_checkout(args.url, args.path, exclusions, inclusions,
-                           dry_run=args.dry_run, verbose=args.verbose)
+        if args.export:
+            do_sparse_export(args.url, args.path, exclusions, inclusions,
+                             dry_run=args.dry_run, verbose=args.verbose, jobs=args.jobs,
+                             ls_cache=not args.no_ls_cache, full=args.full,
+                             planner=args.planner, reporter=reporter)
+        else:
+            do_sparse_checkout(args.url, args.path, exclusions, inclusions,
+                               dry_run=args.dry_run, verbose=args.verbose, jobs=args.jobs,
+                               ls_cache=not args.no_ls_cache, full=args.full,
+                               planner=args.planner, resume=args.resume, reporter=reporter,
+                               reference=args.reference)
+        reporter.finish(args.stats_json)
     except pysvn.ClientError as e:
-        print e.message
+        if _SHOULD_CANCEL:
+            print 'Cancelled. Run again with --resume to continue.'
+        else:
+            print e.message
+        sys.exit(1)
+    except ProfileError as e:
+        print 'ERROR: %s' % (e,)
         sys.exit(1)
     except KeyboardInterrupt:
-        _SHOULD_CANCEL = True
+        print 'Cancelled. Run again with --resume to continue.'
         sys.exit(1)
 
 
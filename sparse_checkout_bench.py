@@ -0,0 +1,231 @@
+"""
+Benchmarks sparse_checkout.py against synthetic local repositories.
+
+    sparse_checkout_bench.py --width 6 --depth 4 --files 20 --runs 5 -o results.json
+    sparse_checkout_bench.py --baseline results.json -o new_results.json
+
+A file:// repository of the requested shape is built with svnadmin, along
+with a profile that excludes part of it, and sparse_checkout.py is timed
+against it per phase over several fresh checkouts.
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import urllib
+
+from subprocess import CalledProcessError
+
+SPARSE_CHECKOUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sparse_checkout.py')
+PHASES = ['info', 'discovery', 'checkout', 'empty updates', 'infinite updates']
+DEFAULT_THRESHOLD = 0.10 # Median slowdown vs the baseline that counts as a regression
+
+
+def call( *args ):
+    try:
+        return subprocess.check_output(list(args))
+    except CalledProcessError as e:
+        print 'ERROR: %s failed (exit code %d)' % (' '.join(args), e.returncode)
+        sys.exit(1)
+    except OSError:
+        print 'ERROR: %s not found on system path' % args[0]
+        sys.exit(1)
+
+
+def path_to_file_url(path):
+    url = urllib.pathname2url(os.path.abspath(path))
+    if url.startswith('///'): # windows drive paths
+        return 'file:' + url
+    return 'file://' + url
+
+
+def build_tree(root, width, depth, files, file_size, rng):
+    # width folders per level down to depth, each holding files of file_size random bytes
+    for n in xrange(files):
+        with open(os.path.join(root, 'f%d.txt' % n), 'wb') as fp:
+            fp.write(''.join(chr(rng.randint(0, 255)) for _ in xrange(file_size)))
+
+    if depth == 0:
+        return
+
+    for n in xrange(width):
+        sub_dir = os.path.join(root, 'd%d' % n)
+        os.mkdir(sub_dir)
+        build_tree(sub_dir, width, depth - 1, files, file_size, rng)
+
+
+def create_repository(work_dir, width, depth, files, file_size, seed):
+    repo_path = os.path.join(work_dir, 'repo')
+    import_path = os.path.join(work_dir, 'import')
+
+    call('svnadmin', 'create', repo_path)
+    os.mkdir(import_path)
+    build_tree(import_path, width, depth, files, file_size, random.Random(seed))
+
+    url = path_to_file_url(repo_path) + '/trunk'
+    call('svn', 'import', '-q', '-m', 'Benchmark tree', import_path, url)
+    shutil.rmtree(import_path)
+    return url
+
+
+def generate_profile(filename, width, depth):
+    """
+    Writes a profile matching the generated tree: every other second level
+    folder is excluded, with the first folder below each exclusion included
+    again, so all of the planner's paths get exercised.
+    """
+    exclusions = []
+    inclusions = []
+    for top in xrange(width):
+        for sub in xrange(1, width, 2):
+            path = 'd%d/d%d' % (top, sub)
+            exclusions.append(path)
+            if depth >= 3:
+                inclusions.append(path + '/d0')
+
+    with open(filename, 'w') as fp:
+        fp.write('# Generated by sparse_checkout_bench.py\n')
+        for path in exclusions:
+            fp.write('-%s\n' % path)
+        for path in inclusions:
+            fp.write('+%s\n' % path)
+
+    return len(exclusions), len(inclusions)
+
+
+def run_checkout(url, dest, profile, stats_filename, extra_args):
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+
+    call(sys.executable, SPARSE_CHECKOUT, url, dest, '-p', profile, '--stats-json', stats_filename, *extra_args)
+    return json.load(open(stats_filename))
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def summarize(runs):
+    # Min/median/max per phase across all runs, plus wall time and peak RSS
+    summary = {}
+    for name in PHASES + ['elapsed']:
+        if name == 'elapsed':
+            values = [ x['elapsed'] for x in runs ]
+        else:
+            values = [ sum(p['elapsed'] for p in x['phases'] if p['name'] == name) for x in runs ]
+        summary[name] = { 'min': min(values), 'median': median(values), 'max': max(values) }
+
+    peak_rss = [ x['peak_rss'] for x in runs if x.get('peak_rss') is not None ]
+    summary['peak_rss'] = max(peak_rss) if peak_rss else None
+    return summary
+
+
+def compare_to_baseline(summary, baseline, threshold):
+    """Prints median times against the baseline, returning the phases which regressed."""
+    regressions = []
+    print '%-18s %10s %10s %8s' % ('phase', 'baseline', 'current', 'change')
+    for name in PHASES + ['elapsed']:
+        if name not in baseline:
+            continue
+
+        old = baseline[name]['median']
+        new = summary[name]['median']
+        change = (new - old) / old if old > 0 else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print '%-18s %9.2fs %9.2fs %+7.1f%%%s' % (name, old, new, change * 100, flag)
+
+    if baseline.get('peak_rss') and summary['peak_rss']:
+        print '%-18s %10d %10d' % ('peak rss', baseline['peak_rss'], summary['peak_rss'])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sparse_checkout.py against a synthetic repository')
+    parser.add_argument('--width', default=4, type=int, help='Folders per level.')
+    parser.add_argument('--depth', default=3, type=int, help='Levels of folders.')
+    parser.add_argument('--files', default=10, type=int, help='Files per folder.')
+    parser.add_argument('--file-size', default=1024, type=int, help='Size of each file in bytes.')
+    parser.add_argument('--seed', default=0, type=int, help='Seed for generated file content.')
+    parser.add_argument('-n', '--runs', default=3, type=int, help='Number of fresh checkouts to time.')
+    parser.add_argument('-o', '--output', default=None, type=str, help='Write results to this JSON file.')
+    parser.add_argument('-b', '--baseline', default=None, type=str, help='Compare against results previously written with --output.')
+    parser.add_argument('--threshold', default=DEFAULT_THRESHOLD, type=float, help='Median slowdown which counts as a regression (0.1 = 10%%).')
+    parser.add_argument('--work-dir', default=None, type=str, help='Folder to build the repository under (a temp folder by default).')
+    parser.add_argument('--ls-cache', default=False, action='store_true', help='Let runs use the persistent svn ls cache (otherwise every run does full discovery).')
+    parser.add_argument('--keep', default=False, action='store_true', help='Keep the work folder afterwards.')
+    parser.add_argument('checkout_args', nargs=argparse.REMAINDER, help='Extra arguments passed to sparse_checkout.py (after --).')
+    args = parser.parse_args()
+
+    extra_args = [ x for x in args.checkout_args if x != '--' ]
+    if not args.ls_cache:
+        extra_args.append('--no-ls-cache')
+    if args.work_dir:
+        work_dir = os.path.join(args.work_dir, 'sparse_bench')
+        if os.path.exists(work_dir):
+            shutil.rmtree(work_dir)
+        os.makedirs(work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix='sparse_bench_')
+
+    try:
+        print 'Building repository in %s (width=%d, depth=%d, files=%d, file size=%d)' % (
+            work_dir, args.width, args.depth, args.files, args.file_size)
+        url = create_repository(work_dir, args.width, args.depth, args.files, args.file_size, args.seed)
+
+        profile = os.path.join(work_dir, 'bench.conf')
+        num_exclusions, num_inclusions = generate_profile(profile, args.width, args.depth)
+        print 'Profile: %d exclusions, %d inclusions' % (num_exclusions, num_inclusions)
+
+        runs = []
+        for n in xrange(args.runs):
+            stats = run_checkout(url, os.path.join(work_dir, 'wc'), profile,
+                                 os.path.join(work_dir, 'stats.json'), extra_args)
+            runs.append(stats)
+            print 'Run %d: %.2fs' % (n + 1, stats['elapsed'])
+
+        summary = summarize(runs)
+        results = {
+            'config': {
+                'width': args.width,
+                'depth': args.depth,
+                'files': args.files,
+                'file_size': args.file_size,
+                'runs': args.runs,
+                'exclusions': num_exclusions,
+                'inclusions': num_inclusions,
+                'checkout_args': extra_args },
+            'runs': runs,
+            'summary': summary }
+
+        if args.output:
+            json.dump(results, open(args.output, 'w'), indent=2, sort_keys=True)
+            print 'Wrote', args.output
+
+        if args.baseline:
+            baseline = json.load(open(args.baseline))
+            if baseline['config']['width'] != args.width or baseline['config']['depth'] != args.depth:
+                print 'WARNING: baseline was recorded against a different repository shape'
+            if compare_to_baseline(summary, baseline['summary'], args.threshold):
+                sys.exit(1)
+        else:
+            for name in PHASES + ['elapsed']:
+                print '%-18s median %.2fs (min %.2fs, max %.2fs)' % (
+                    name, summary[name]['median'], summary[name]['min'], summary[name]['max'])
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,28 @@
+"""
+Reverts a working copy and deletes everything unversioned or ignored in it,
+leaving it as clean as a fresh checkout.
+
+svn status is read as it streams in, and each item is handed to a bounded
+pool of threads to delete, so huge ignored build outputs don't wait for the
+whole status, or on each other. With --rename-aside, directories are moved
+into the working copy's .svn/tmp rather than deleted, and a background
+process deletes them after, so the tree is clean as soon as they're moved.
+
+Any number of working copies can be given, or found by scanning a directory
+for them, and they're cleaned several at a time, each one's output printed
+together once it's done.
+"""
 import os
 import sys
+import stat
+import Queue
+import fnmatch
+import argparse
+import tempfile
+import threading
 import subprocess
 import shutil
+import multiprocessing.pool
 
 
 STATUS_NAMES = {
@@ -9,31 +30,415 @@ STATUS_NAMES = {
 	"I": "ignored",
 }
 
-path = sys.argv[1]
+def find_wc_root( path ):
+	# Working copies since svn 1.7 have a single .svn, at their root
+	path = os.path.abspath( path )
+	while not os.path.isdir( os.path.join( path, ".svn" ) ):
+		parent = os.path.dirname( path )
+		if parent == path:
+			return None
+		path = parent
+	return path
 
-os.system( 'svn revert -R "%s"' % path )
+def make_writable_and_retry( func, path, exc_info ):
+	# Read-only files can't be deleted on Windows
+	if not os.access( path, os.W_OK ):
+		os.chmod( path, stat.S_IWRITE )
+		func( path )
+	else:
+		raise exc_info[0], exc_info[1], exc_info[2]
 
-output = subprocess.check_output(['svn', 'status', '--no-ignore', '%s' % path])
-for line in [ x.strip() for x in output.splitlines() if len(x.strip()) > 0 ]:
-	if line[0] not in STATUS_NAMES.keys():
-		continue
-	
-	status = STATUS_NAMES[line[0]]
+def remove_file( path ):
+	try:
+		os.remove( path )
+	except OSError:
+		make_writable_and_retry( os.remove, path, sys.exc_info() )
 
-	filename = line[1:].strip()
+def remove_tree( path ):
+	shutil.rmtree( path, onerror=make_writable_and_retry )
 
-	if os.path.isfile( filename ):
-		try:
-			os.remove( filename )
-			print 'Deleted %s file \'%s\'' % (status, filename)
-		except Exception, e:
-			print 'Failed to delete file \'%s\'' % filename
-			print '\t', str(e)
-	elif os.path.isdir( filename ):
+def tree_size( path ):
+	size = 0
+	for dirpath, dirnames, filenames in os.walk( path ):
+		for filename in filenames:
+			try:
+				size += os.lstat( os.path.join( dirpath, filename ) ).st_size
+			except OSError:
+				pass
+	return size
+
+def print_line( line ):
+	print line
+
+def find_wc_roots( path, max_depth ):
+	# Working copies don't nest, so there's no need to look inside one
+	roots = []
+	base_depth = os.path.abspath( path ).rstrip( os.sep ).count( os.sep )
+	for dirpath, dirnames, filenames in os.walk( path ):
+		if ".svn" in dirnames:
+			roots.append( dirpath )
+			del dirnames[:]
+		elif os.path.abspath( dirpath ).count( os.sep ) - base_depth >= max_depth:
+			del dirnames[:]
+	return sorted( roots )
+
+def check_paths( paths ):
+	"""
+	Returns the absolute paths to clean, without duplicates, or raises
+	ValueError if any isn't in a working copy, or two are in the same one
+	or one inside the other, which would have svn lock one against the other.
+	"""
+	result = []
+	roots = {}
+	for path in paths:
+		path = os.path.normpath( os.path.abspath( path ) )
+		root = find_wc_root( path )
+		if root is None:
+			raise ValueError( "'%s' is not in a working copy" % path )
+		if root in roots:
+			if os.path.normcase( roots[root] ) != os.path.normcase( path ):
+				raise ValueError( "'%s' and '%s' are in the same working copy" % (roots[root], path) )
+			continue
+		roots[root] = path
+		result.append( path )
+
+	for path in result:
+		for other in result:
+			if os.path.normcase( other ).startswith( os.path.normcase( path ).rstrip( os.sep ) + os.sep ):
+				raise ValueError( "'%s' is inside '%s'" % (other, path) )
+	return result
+
+def format_size( size ):
+	for unit in [ "bytes", "KB", "MB", "GB" ]:
+		if size < 1024 or unit == "GB":
+			return ("%d %s" if unit == "bytes" else "%.1f %s") % (size, unit)
+		size /= 1024.0
+
+
+class Cleaner( object ):
+	"""
+	Deletes items on a pool of worker threads, or with dry_run, only totals
+	up what would be deleted. Items matching a keep glob are left alone:
+	globs with a / match the path relative to root, a folder at a time, and
+	others match names at any depth. Directories holding kept items are
+	emptied around them, and all others are deleted whole.
+	"""
+	def __init__( self, root, jobs=8, keep=(), dry_run=False, trash_dir=None, write=print_line ):
+		self.root = root
+		self.write = write
+		self.keep = [ x.replace( "\\", "/" ).rstrip( "/" ) for x in keep ]
+		self.dry_run = dry_run
+		self.trash_dir = trash_dir
+		self.renamed = 0
+		self.counts = { "file": 0, "directory": 0, "kept": 0, "failed": 0 }
+		self.bytes = 0
+		self.lock = threading.Lock()
+
+		# Bounded, so a fast status can't queue up every path in memory ahead of the deletes
+		self.queue = Queue.Queue( jobs * 64 )
+		self.threads = [ threading.Thread( target=self.worker ) for i in range( jobs ) ]
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+
+	def submit( self, status, path ):
+		self.queue.put( (status, path) )
+
+	def finish( self ):
+		for thread in self.threads:
+			self.queue.put( None )
+		for thread in self.threads:
+			thread.join()
+
+	def worker( self ):
+		for status, path in iter( self.queue.get, None ):
+			try:
+				self.clean( status, path )
+			except Exception, e:
+				# A worker that stopped would leave submit() and finish() blocked on a full queue
+				with self.lock:
+					self.counts["failed"] += 1
+				try:
+					self.output( 'Failed to clean \'%s\'' % path, '\t' + str( e ) )
+				except Exception:
+					pass
+
+	def output( self, *lines ):
+		with self.lock:
+			for line in lines:
+				self.write( line )
+
+	def relpath( self, path ):
+		return os.path.relpath( path, self.root ).replace( "\\", "/" )
+
+	def is_kept( self, relpath ):
+		# Globs with a / match the path a folder at a time, so * stays within one, and others match names at any depth
+		parts = relpath.split( "/" )
+		for pattern in self.keep:
+			pattern_parts = pattern.split( "/" )
+			if len( pattern_parts ) == 1:
+				if fnmatch.fnmatch( parts[-1], pattern ):
+					return True
+			elif len( pattern_parts ) == len( parts ) and all( fnmatch.fnmatch( x, y ) for x, y in zip( parts, pattern_parts ) ):
+				return True
+		return False
+
+	def may_keep_inside( self, relpath ):
+		# Whether a keep glob could match something under this directory, without looking
+		parts = relpath.split( "/" )
+		for pattern in self.keep:
+			pattern_parts = pattern.split( "/" )
+			if len( pattern_parts ) == 1:
+				return True
+			if len( pattern_parts ) > len( parts ) and all( fnmatch.fnmatch( x, y ) for x, y in zip( parts, pattern_parts ) ):
+				return True
+		return False
+
+	def find_kept( self, path ):
+		"""Returns the relative paths of kept items under a directory, only walking where keep globs could match."""
+		kept = set()
+		for dirpath, dirnames, filenames in os.walk( path ):
+			for name in filenames:
+				relpath = self.relpath( os.path.join( dirpath, name ) )
+				if self.is_kept( relpath ):
+					kept.add( relpath )
+
+			descend = []
+			for name in dirnames:
+				relpath = self.relpath( os.path.join( dirpath, name ) )
+				if self.is_kept( relpath ):
+					kept.add( relpath )
+				elif self.may_keep_inside( relpath ):
+					descend.append( name )
+			dirnames[:] = descend
+		return kept
+
+	def clean( self, status, path ):
+		relpath = self.relpath( path )
+		if self.is_kept( relpath ):
+			with self.lock:
+				self.counts["kept"] += 1
+			return
+		if not os.path.lexists( path ):
+			return # e.g. a missing item, which revert will have restored
+
+		# Directories are only emptied around what they actually keep, otherwise they go whole
+		if os.path.isdir( path ) and not os.path.islink( path ) and self.may_keep_inside( relpath ):
+			kept = self.find_kept( path )
+			if kept:
+				self.clean_around( status, path, kept )
+				return
+		self.delete( status, path )
+
+	def clean_around( self, status, path, kept ):
+		with self.lock:
+			self.counts["kept"] += len( kept )
+
+		# Only folders holding kept items are descended into, everything else is deleted whole
+		holding = set()
+		for relpath in kept:
+			parts = relpath.split( "/" )
+			holding.update( "/".join( parts[:i] ) for i in range( 1, len( parts ) ) )
+
+		def descend( path ):
+			for name in os.listdir( path ):
+				child = os.path.join( path, name )
+				relpath = self.relpath( child )
+				if relpath in holding:
+					descend( child )
+				elif relpath not in kept:
+					self.delete( status, child )
+		descend( path )
+
+	def delete( self, status, path ):
+		is_dir = os.path.isdir( path ) and not os.path.islink( path )
+		kind = "directory" if is_dir else "file"
 		try:
-			shutil.rmtree( filename )
-			print 'Deleted %s directory \'%s\'' % (status, filename)
-		except Exception, e:
-			print 'Failed to delete directory \'%s\'' % filename
-			print '\t', str(e)
-		
+			if self.dry_run:
+				size = tree_size( path ) if is_dir else os.lstat( path ).st_size
+				with self.lock:
+					self.bytes += size
+			elif is_dir:
+				self.remove_dir( path )
+			else:
+				remove_file( path )
+		except (OSError, IOError), e:
+			with self.lock:
+				self.counts["failed"] += 1
+			self.output( 'Failed to delete %s \'%s\'' % (kind, path), '\t' + str( e ) )
+			return
+
+		with self.lock:
+			self.counts[kind] += 1
+		if not self.dry_run:
+			self.output( 'Deleted %s %s \'%s\'' % (status, kind, path) )
+
+	def remove_dir( self, path ):
+		if self.trash_dir:
+			with self.lock:
+				self.renamed += 1
+				trash_path = os.path.join( self.trash_dir, str( self.renamed ) )
+			try:
+				os.rename( path, trash_path )
+				return
+			except OSError:
+				pass # e.g. something has a file open in it on Windows, so delete what can be
+		remove_tree( path )
+
+
+TRASH_PREFIX = "svn-revert-all-"
+
+def create_trash_dir( root ):
+	# .svn/tmp is on the same volume, so renaming into it is instant, and svn ignores it
+	svn_tmp = os.path.join( root, ".svn", "tmp" )
+	if not os.path.isdir( svn_tmp ):
+		return None
+	return tempfile.mkdtemp( prefix=TRASH_PREFIX, dir=svn_tmp )
+
+def find_stale_trash( root ):
+	# Left by earlier runs whose background delete was killed, e.g. with the build job
+	svn_tmp = os.path.join( root, ".svn", "tmp" )
+	if not os.path.isdir( svn_tmp ):
+		return []
+	return [ os.path.join( svn_tmp, x ) for x in os.listdir( svn_tmp ) if x.startswith( TRASH_PREFIX ) ]
+
+def delete_in_background( paths ):
+	# A separate process, which carries on after this one and whatever started it have exited
+	script = "import shutil, sys; [ shutil.rmtree(x, ignore_errors=True) for x in sys.argv[1:] ]"
+	args = [ sys.executable, "-c", script ] + list( paths )
+	if sys.platform != "win32":
+		subprocess.Popen( args, close_fds=True, preexec_fn=os.setsid )
+		return
+
+	DETACHED_PROCESS = 0x00000008
+	CREATE_BREAKAWAY_FROM_JOB = 0x01000000
+	try:
+		subprocess.Popen( args, close_fds=True, creationflags=DETACHED_PROCESS | CREATE_BREAKAWAY_FROM_JOB )
+	except OSError:
+		# The job doesn't allow breaking away, so the next run sweeps up whatever is left
+		subprocess.Popen( args, close_fds=True, creationflags=DETACHED_PROCESS )
+
+def revert( path, cleaner ):
+	proc = subprocess.Popen( [ 'svn', 'revert', '-R', path ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT )
+	for line in iter( proc.stdout.readline, "" ):
+		cleaner.output( line.rstrip( "\r\n" ) )
+	proc.stdout.close()
+	return proc.wait()
+
+def clean_status( path, cleaner ):
+	# Hands items to the cleaner as svn finds them, rather than after the whole status
+	proc = subprocess.Popen( [ 'svn', 'status', '--no-ignore', path ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT )
+	for line in iter( proc.stdout.readline, "" ):
+		line = line.rstrip( "\r\n" )
+		if line.startswith( "svn: " ):
+			cleaner.output( line )
+		if len( line ) < 9 or line[0] not in STATUS_NAMES:
+			continue
+		cleaner.submit( STATUS_NAMES[line[0]], line[8:] )
+	proc.stdout.close()
+	return proc.wait()
+
+def revert_all( path, args, write=print_line ):
+	"""Reverts and cleans one working copy, returning whether it all succeeded."""
+	trash_dir = None
+	stale_trash = []
+	root = find_wc_root( path )
+	if root and not args.dry_run:
+		stale_trash = find_stale_trash( root )
+		if stale_trash and not args.rename_aside:
+			for stale in stale_trash:
+				shutil.rmtree( stale, ignore_errors=True )
+			stale_trash = []
+	if args.rename_aside and not args.dry_run:
+		trash_dir = create_trash_dir( root ) if root else None
+		if not trash_dir:
+			write( "No .svn/tmp to rename directories aside into, deleting them in place" )
+
+	cleaner = Cleaner( path, args.jobs, args.keep, args.dry_run, trash_dir, write )
+	try:
+		revert_failed = not args.dry_run and revert( path, cleaner ) != 0
+		status_failed = clean_status( path, cleaner ) != 0
+	finally:
+		cleaner.finish()
+
+	counts = cleaner.counts
+	if args.dry_run:
+		write( "Would delete %d files and %d directories, %s" % (counts["file"], counts["directory"], format_size( cleaner.bytes )) )
+	else:
+		write( "Deleted %d files and %d directories" % (counts["file"], counts["directory"]) )
+	if counts["kept"]:
+		write( "Kept %d items" % counts["kept"] )
+
+	if trash_dir:
+		if cleaner.renamed:
+			write( "Deleting %d directories in the background" % cleaner.renamed )
+			stale_trash.append( trash_dir )
+		else:
+			os.rmdir( trash_dir )
+	if stale_trash:
+		delete_in_background( stale_trash )
+
+	if counts["failed"]:
+		write( "Failed to delete %d items" % counts["failed"] )
+	return not (revert_failed or status_failed or counts["failed"])
+
+def revert_buffered( path, args ):
+	# Collects a working copy's output, to print in one piece amongst the others
+	lines = []
+	try:
+		succeeded = revert_all( path, args, lines.append )
+	except Exception, e:
+		lines.append( "Failed to revert '%s'" % path )
+		lines.append( "\t" + str( e ) )
+		succeeded = False
+	return path, succeeded, lines
+
+
+def main():
+	parser = argparse.ArgumentParser( description="Reverts working copies and deletes everything unversioned or ignored in them." )
+	parser.add_argument( "paths", metavar="path", nargs="*", help="Working copy, or directory in one, to clean." )
+	parser.add_argument( "-s", "--scan", metavar="DIR", action="append", default=[], help="Also clean every working copy found under this directory (may be repeated)." )
+	parser.add_argument( "--scan-depth", metavar="N", default=3, type=int, help="How many folders deep --scan looks for working copies (3 by default)." )
+	parser.add_argument( "-w", "--workers", metavar="N", default=4, type=int, help="Working copies to clean at once (4 by default)." )
+	parser.add_argument( "-j", "--jobs", metavar="N", default=8, type=int, help="Threads deleting at once in each working copy (8 by default)." )
+	parser.add_argument( "-k", "--keep", metavar="GLOB", action="append", default=[], help="Don't delete items matching this path or name glob (may be repeated)." )
+	parser.add_argument( "-n", "--dry-run", action="store_true", help="Don't revert or delete anything, only report what would be deleted." )
+	parser.add_argument( "--rename-aside", action="store_true", help="Move directories into .svn/tmp and delete them in the background." )
+	args = parser.parse_args()
+
+	paths = list( args.paths )
+	for scan_dir in args.scan:
+		paths += find_wc_roots( scan_dir, args.scan_depth )
+	try:
+		paths = check_paths( paths )
+	except ValueError, e:
+		parser.error( str( e ) )
+	if not paths:
+		parser.error( "no working copies to clean" )
+
+	# A single working copy's output streams out as it goes
+	if len( paths ) == 1:
+		if not revert_all( paths[0], args ):
+			sys.exit( 1 )
+		return
+
+	failed = []
+	pool = multiprocessing.pool.ThreadPool( max( 1, min( args.workers, len( paths ) ) ) )
+	for path, succeeded, lines in pool.imap_unordered( lambda x: revert_buffered( x, args ), paths ):
+		print "== %s ==" % path
+		for line in lines:
+			print line
+		print
+		if not succeeded:
+			failed.append( path )
+	pool.close()
+	pool.join()
+
+	print "Cleaned %d of %d working copies" % (len( paths ) - len( failed ), len( paths ))
+	for path in failed:
+		print "Failed: %s" % path
+	if failed:
+		sys.exit( 1 )
+
+if __name__ == "__main__":
+	main()
@@ -2,37 +2,53 @@
     svn-shelve --shelve --revert .
     svn-shelve --unshelve 1234 .
     svn-shelve --info 1234
+    svn-shelve --list --all --url trunk --limit 20
+    svn-shelve --reindex
+    svn-shelve --pack --older-than 90
+    svn-shelve --prune --max-age 730 --max-size 20000
+    svn-shelve --serve
 """
 import os
 import re
 import sys
 import argparse
 import pickle
+import shutil
+import signal
 import time
+import sqlite3
+import json
+import tempfile
+import threading
+import SocketServer
 import socket
 import getpass
-import subprocess
+import fnmatch
 import portalocker
 import multiprocessing
 
 from pprint import pprint
 from os.path import join, normpath, relpath
-from subprocess import CalledProcessError
 
 from svn_shelve_config import CONFIG
+from svn_shelve_backend import create_backend, SvnError, BACKENDS
+
+import svn_patch
+from svn_shelve_storage import get_storage_path, read_meta, store_patch_stream, store_stream, write_manifest, read_shelf_index, read_shelf_patch, extract_shelf_patch, shelf_base_reader, META_FILENAME
+from svn_shelve_storage import shelf_exists, list_shelves, shelf_blobs, shelf_files_size, blob_size, pack_shelves, delete_shelves, get_packs_dir, make_dirs
 
 START_ID = 1000
 DEBUG = False
-
-def call_svn( *args ):
-    try:
-        return subprocess.check_output( ["svn"] + list(args) )
-    except CalledProcessError as e:
-        # stderr gets directed out to user already, just exit with code.
-        sys.exit(e.returncode)
-    except KeyboardInterrupt as e:
-        sys.exit(1)
-
+CATALOG_FILENAME = ".catalog.db"
+LEASE_FILENAME = ".svn_shelve_lease"
+ID_BLOCK_SIZE = 50
+LOCK_WAIT = {"central": 0.0, "local": 0.0} # Seconds spent waiting on locks, reported by do_tests
+SVN = None # Subversion backend, see svn_shelve_backend
+USE_SERVICE = True
+SERVICE_PORT = 7315 # Localhost port of the shelf service where Unix sockets aren't available
+SERVICE_CONNECT_TIMEOUT = 0.5
+SERVICE_TIMEOUT = 60
+SERVICE_ENCODING = "latin-1" # Byte strings go through JSON unchanged, whatever their real encoding
 
 def print_info( *args ):
     print " ".join(str(x) for x in args)
@@ -45,59 +61,326 @@ def fatal( *args ):
     print "ERROR:", " ".join(str(x) for x in args)
     sys.exit(1)
 
-def generate_new_id():
+def lock_exclusive(fp, kind):
+    # Locks fp, accounting the time spent waiting for do_tests
+    start = time.time()
+    portalocker.lock(fp, portalocker.LOCK_EX)
+    LOCK_WAIT[kind] += time.time() - start
+
+def write_locked(fp, content):
+    # Replaces the content of a locked file, making sure it's on disk before we carry on
+    fp.seek(0)
+    fp.truncate()
+    fp.write(content)
+    fp.flush()
+    os.fsync(fp.fileno())
+
+class IdError(Exception):
+    pass
+
+def reserve_ids(count):
     """
-    Generates a new unique ID by using a centralized id file, which we gain
-    an exclusive lock on so that only one client may be generating an ID at 
+    Reserves count consecutive ID's by using a centralized id file, which we gain
+    an exclusive lock on so that only one client may be reserving ID's at 
     a particular time. This should guarantee unique id's in a distributed fashion,
     assuming file system guarantees mutual exclusivity. Only danger is a client
     may hang up and leave the file locked, however this should be unlikely.
+    Returns the first reserved ID, or raises IdError.
     """
     # Check location exists
     if not os.path.isdir(CONFIG.local_storage):
-        fatal("Configured path not found at", CONFIG.local_storage)
+        raise IdError("Configured path not found at %s" % (CONFIG.local_storage,))
 
     id_file = join(CONFIG.local_storage, ".id_gen")
 
     # Open file and gain lock
     try:
         with open(id_file, "a+") as fp:
-            portalocker.lock(fp, portalocker.LOCK_EX)
+            lock_exclusive(fp, "central")
 
             # Read last ID generated
             fp.seek(0)
+            last_id = START_ID
             try:
                 content = fp.read().strip()
                 last_id = int(content)
                 print_debug("Last id =", last_id)
             except ValueError:
                 print_debug("%s contains invalid content (%s). Assuming first use." % (id_file, content))
-                last_id = START_ID
             except IOError:
                 print_debug("Could not read content from %s. Assuming first use." % (id_file,))
 
-            # Generate new ID
-            new_id = last_id + 1
+            # Write out the last ID reserved
+            write_locked(fp, str(last_id + count))
+    except EnvironmentError as e:
+        raise IdError("Could not open and exclusively lock %s" % (id_file,))
+
+    print_debug("Reserved ids %d-%d" % (last_id + 1, last_id + count))
+    return last_id + 1
+
+def generate_central_id():
+    """Generates a new unique ID straight from the centralized id file."""
+    return reserve_ids(1)
+
+def generate_new_id():
+    """
+    Generates a new unique ID from a block of ID's leased from the centralized
+    id file. The lease is cached on local disk, so most ID's only need a lock
+    on the local lease file. The lease is advanced on disk before an ID is
+    handed out, and the central file before a lease is written, so a crash
+    can only waste ID's, never reuse them.
+    """
+    lease_filename = join(os.path.expanduser("~"), LEASE_FILENAME)
+
+    try:
+        with open(lease_filename, "a+") as fp:
+            lock_exclusive(fp, "local")
 
-            # Write out newly generated ID
             fp.seek(0)
-            fp.truncate()
-            fp.write(str(new_id))
+            try:
+                lease = pickle.loads(fp.read())
+            except Exception:
+                lease = None
+
+            # Leases are only valid for the storage they were taken from
+            if not lease or lease["storage"] != CONFIG.local_storage or lease["next"] >= lease["end"]:
+                first_id = reserve_ids(ID_BLOCK_SIZE)
+                lease = {"storage": CONFIG.local_storage, "next": first_id, "end": first_id + ID_BLOCK_SIZE}
+                print_debug("Leased ids %d-%d" % (lease["next"], lease["end"] - 1))
+
+            new_id = lease["next"]
+            lease["next"] += 1
+            write_locked(fp, pickle.dumps(lease))
     except EnvironmentError as e:
-        fatal("Could not open and exclusively lock %s" % (id_file,))
+        raise IdError("Could not open and exclusively lock %s" % (lease_filename,))
 
     print_debug("Generated id =", new_id)
     return new_id
 
-def get_storage_path(id):
-    return join(CONFIG.local_storage, str(id))
 
+def open_catalog(check_same_thread=True):
+    """
+    Opens the shelf catalog, an sqlite index of every shelf's meta data kept
+    alongside the shelves, so listing doesn't need to unpickle each shelf.
+    The per-shelf directories remain the source of truth (see --reindex).
+    """
+    catalog_filename = join(CONFIG.local_storage, CATALOG_FILENAME)
+    is_new = not os.path.isfile(catalog_filename)
+
+    db = sqlite3.connect(catalog_filename, timeout=60, check_same_thread=check_same_thread)
+    db.text_factory = str
+    db.execute("CREATE TABLE IF NOT EXISTS shelves ("
+               "id INTEGER PRIMARY KEY, username TEXT, hostname TEXT, url TEXT, "
+               "revision INTEGER, created REAL, message TEXT, target_dir TEXT)")
+    db.execute("CREATE INDEX IF NOT EXISTS shelves_user_host ON shelves (username, hostname, created)")
+    db.execute("CREATE INDEX IF NOT EXISTS shelves_url ON shelves (url, created)")
+    db.execute("CREATE INDEX IF NOT EXISTS shelves_created ON shelves (created)")
+    db.commit()
+
+    if is_new:
+        print_debug("Created catalog", catalog_filename)
+        reindex_catalog(db)
+    return db
+
+def get_meta_timestamp(meta, storage_path):
+    # Older shelves only recorded a ctime() string
+    if "timestamp" in meta:
+        return meta["timestamp"]
+    try:
+        return time.mktime(time.strptime(meta["local_timestamp"]))
+    except (KeyError, ValueError):
+        pass
+    try:
+        return os.path.getmtime(join(storage_path, META_FILENAME))
+    except OSError:
+        return 0
+
+def catalog_add(db, meta, created):
+    db.execute("INSERT OR REPLACE INTO shelves VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+               (meta["id"], meta["username"], meta["hostname"], meta["url"],
+                meta["revision"], created, meta["message"], meta["target_dir"]))
+
+def reindex_catalog(db):
+    """Rebuilds the catalog from the shelves, loose and packed, in a single transaction."""
+    count = 0
+    with db:
+        db.execute("DELETE FROM shelves")
+        for name in list_shelves():
+            storage_path = get_storage_path(name)
+            try:
+                meta = read_meta(storage_path)
+                catalog_add(db, meta, get_meta_timestamp(meta, storage_path))
+                count += 1
+            except (IOError, ValueError, KeyError, pickle.UnpicklingError) as e:
+                print_debug("Skipping", storage_path, e)
+    return count
+
+
+class ServiceError(Exception):
+    pass
+
+def get_service_address():
+    # A Unix socket path, or a (host, port) for localhost TCP
+    address = getattr(CONFIG, "service_address", None)
+    if address is not None:
+        return address
+    if hasattr(socket, "AF_UNIX"):
+        return join(tempfile.gettempdir(), "svn_shelve_%s.sock" % getpass.getuser())
+    return ("127.0.0.1", SERVICE_PORT)
+
+def from_json(value):
+    if isinstance(value, unicode):
+        return value.encode(SERVICE_ENCODING)
+    if isinstance(value, list):
+        return [ from_json(x) for x in value ]
+    if isinstance(value, dict):
+        return dict((from_json(k), from_json(v)) for k, v in value.iteritems())
+    return value
+
+def to_json(value):
+    return json.dumps(value, encoding=SERVICE_ENCODING) + "\n"
+
+
+class ServiceClient(object):
+    """Sends requests to the shelf service, one JSON document per line each way."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.rfile = sock.makefile("rb")
+
+    def call(self, op, **args):
+        args["op"] = op
+        try:
+            self.sock.sendall(to_json(args))
+            line = self.rfile.readline()
+        except socket.error as e:
+            raise ServiceError(e)
+        if not line:
+            raise ServiceError("Connection closed")
+
+        response = from_json(json.loads(line))
+        if "error" in response:
+            raise ServiceError(response["error"])
+        return response["result"]
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+def connect_service(address=None):
+    """Returns a client of the shelf service, or None when it isn't running (or is disabled)."""
+    if not USE_SERVICE and address is None:
+        return None
+    if address is None:
+        address = get_service_address()
+
+    sock = socket.socket(socket.AF_UNIX if isinstance(address, str) else socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(SERVICE_CONNECT_TIMEOUT)
+    try:
+        sock.connect(address)
+    except socket.error:
+        sock.close()
+        return None
 
-def check_environment():
+    sock.settimeout(SERVICE_TIMEOUT)
+    print_debug("Connected to shelf service at", address)
+    return ServiceClient(sock)
+
+
+class ShelfService(object):
+    """
+    Serves ID allocation, catalog queries and shelf commits for the clients
+    of one machine. IDs come from blocks reserved in the central id file and
+    held in memory, and the catalog connection is shared, one request at a
+    time.
+    """
+    def __init__(self):
+        self.db = open_catalog(check_same_thread=False)
+        self.db_lock = threading.Lock()
+        self.id_lock = threading.Lock()
+        self.next_id = self.end_id = 0
+
+    def generate_id(self):
+        with self.id_lock:
+            if self.next_id >= self.end_id:
+                self.next_id = reserve_ids(ID_BLOCK_SIZE)
+                self.end_id = self.next_id + ID_BLOCK_SIZE
+            new_id = self.next_id
+            self.next_id += 1
+            return new_id
+
+    def handle(self, request):
+        op = request.pop("op", None)
+        if op == "ping":
+            return "pong"
+        if op == "new_id":
+            return self.generate_id()
+        if op == "list":
+            with self.db_lock:
+                return [ list(x) for x in query_catalog(self.db, **request) ]
+        if op == "commit":
+            with self.db_lock:
+                return store_shelf(self.db, request["meta"], request["manifest"], self.generate_id)
+        raise ValueError("Unknown request %r" % op)
+
+class ServiceHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            try:
+                response = {"result": self.server.service.handle(from_json(json.loads(line)))}
+            except Exception as e:
+                print_debug("Request failed:", line.strip(), e)
+                response = {"error": "%s: %s" % (type(e).__name__, e)}
+            self.wfile.write(to_json(response))
+            self.wfile.flush()
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128 # Clients connect in bursts, e.g. from build scripts
+
+if hasattr(socket, "AF_UNIX"):
+    class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+def create_service_server(address):
+    if isinstance(address, str):
+        server = ThreadingUnixServer(address, ServiceHandler)
+    else:
+        server = ThreadingTCPServer(tuple(address), ServiceHandler)
+    server.service = ShelfService()
+    return server
+
+def do_serve():
+    address = get_service_address()
+    if isinstance(address, str) and os.path.exists(address):
+        service = connect_service(address)
+        if service:
+            fatal("Shelf service already running at", address)
+        os.remove(address) # Left behind by a service which didn't shut down cleanly
+
+    server = create_service_server(address)
+    print_info("Shelf service listening on", address)
+
+    # Shut down cleanly when stopped as a service, as for Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
-        result = call_svn("--version")
-    except WindowsError:
-        fatal("Subversion not found on system path")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+
+
+def check_environment(backend_name, stream_diff=False):
+    global SVN
+    try:
+        SVN = create_backend(backend_name, stream_diff)
+        print_debug("Using %s backend, Subversion %s" % (SVN.name, SVN.version()))
+    except SvnError as e:
+        fatal(e)
     
 def humanize_key(s):
     return s.replace("_", " ").title()
@@ -115,197 +398,485 @@ def extract_first_line(s):
     return line
 
 
-def do_list():
-    storage_root = get_storage_path("")
-    
-    curr_user = getpass.getuser()
-    curr_host = socket.gethostname()
+def query_catalog(db, username=None, hostname=None, url=None, limit=None, offset=0):
+    where = []
+    params = []
+    if username is not None:
+        where.append("username = ?")
+        params.append(username)
+    if hostname is not None:
+        where.append("hostname = ?")
+        params.append(hostname)
+    if url is not None:
+        # The url is matched literally, so LIKE's wildcards in it must be escaped
+        where.append("url LIKE ? ESCAPE '\\'")
+        params.append("%" + url.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%")
+
+    query = "SELECT id, username, hostname, url, message FROM shelves"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY created DESC LIMIT ? OFFSET ?"
+    params.extend([limit if limit is not None else -1, offset])
+
+    print_debug("Listing shelves:", query, params)
+    return db.execute(query, params).fetchall()
+
+def store_shelf(db, meta, manifest, generate_id):
+    """Allocates an ID for a shelf whose blobs are stored, then writes its meta and manifest and catalogs it."""
+    new_id = generate_id()
+    while shelf_exists( new_id ):
+        new_id = generate_id()
 
-    print_debug("Listing user shelves from", storage_root)
-    print_debug("Username:", curr_user)
-    print_debug("Hostname:", curr_host)
+    storage_path = get_storage_path(new_id)
+    os.makedirs(storage_path)
+    meta["id"] = new_id
 
-    print_info("Shelves for %s@%s:\n" %(curr_user, curr_host))
+    # Write all, and only index the shelf if that succeeds
+    meta_filename = join(storage_path, META_FILENAME)
+    with db:
+        catalog_add(db, meta, meta["timestamp"])
 
+        file(meta_filename, "wb").write(pickle.dumps(meta))
+        print_debug("Wrote", meta_filename)
 
-    for name in os.listdir(storage_root):
-        meta_filename = join(storage_root, name, "meta")
-        if not os.path.isfile(meta_filename):
-            continue
+        write_manifest(storage_path, manifest)
+        print_debug("Wrote manifest of %d blobs" % len(manifest))
 
-        try:
-            print_debug("Unpickling", meta_filename)
-            meta = pickle.loads(open(meta_filename, "rb").read())
-        except IOError:
-            continue
-        except ValueError as e:
-            print_debug("Failed to de-pickle:", e.message)
-            continue
+    return new_id
 
+
+def do_list(username=None, hostname=None, url=None, limit=None, offset=0):
+    rows = None
+    service = connect_service()
+    if service:
         try:
-            username = meta["username"]
-            hostname = meta["hostname"]
-            id = meta["id"]
-            message = meta["message"]
-            url = meta["url"]        
-        except KeyError as e:
-            print_debug("Missing key from meta-data:", e.message)
-            continue
+            rows = service.call("list", username=username, hostname=hostname, url=url, limit=limit, offset=offset)
+        except ServiceError as e:
+            print_debug("Shelf service failed, listing from the catalog:", e)
+    if rows is None:
+        rows = query_catalog(open_catalog(), username, hostname, url, limit, offset)
+
+    if username is not None and hostname is not None:
+        print_info("Shelves for %s@%s:\n" % (username, hostname))
+    else:
+        print_info("Shelves for %s@%s:\n" % (username or "*", hostname or "*"))
 
-        if username != curr_user or hostname != curr_host:
-            continue
+    for id, shelf_user, shelf_host, shelf_url, message in rows:
+        if username is None or hostname is None:
+            print_info("%d: %s@%s %s (%s)" % (id, shelf_user, shelf_host, extract_first_line(message), shelf_url))
+        else:
+            print_info("%d: %s (%s)" % (id, extract_first_line(message), shelf_url))
 
-        print_info("%d: %s (%s)" % (id, extract_first_line(message), url))
-    
+
+def do_reindex():
+    count = reindex_catalog(open_catalog())
+    print_info("Indexed %d shelves" % count)
+
+
+def lock_maintenance():
+    # Only one --pack or --prune may run at a time; the lock is released when the file is closed
+    make_dirs(get_packs_dir())
+    fp = open(join(get_packs_dir(), ".lock"), "a+")
+    try:
+        lock_exclusive(fp, "central")
+    except EnvironmentError:
+        fatal("Could not lock %s for maintenance" % get_packs_dir())
+    return fp
+
+def do_pack(older_than_days):
+    cutoff = time.time() - older_than_days * 24 * 60 * 60
+    lock = lock_maintenance()
+
+    names = [ str(x[0]) for x in open_catalog().execute("SELECT id FROM shelves WHERE created < ?", (cutoff,)) ]
+    pack_name, size = pack_shelves(names)
+    if pack_name is None:
+        print_info("No loose shelves older than %d days" % older_than_days)
+    else:
+        print_info("Packed shelves older than %d days into %s (%.1f MB)" % (older_than_days, pack_name, size / 1048576.0))
+    lock.close()
+
+def do_prune(max_age_days, max_size_mb):
+    """
+    Deletes shelves older than max_age_days, then the oldest shelves until
+    storage fits in max_size_mb. Blobs shared between shelves count once,
+    and are only freed with the last shelf using them.
+    """
+    if max_age_days is None and max_size_mb is None:
+        fatal("--prune needs --max-age and/or --max-size")
+    lock = lock_maintenance()
+
+    db = open_catalog()
+    shelves = [ (str(id), created) for id, created in db.execute("SELECT id, created FROM shelves ORDER BY created") ]
+    doomed = []
+
+    if max_age_days is not None:
+        cutoff = time.time() - max_age_days * 24 * 60 * 60
+        doomed = [ name for name, created in shelves if created < cutoff ]
+
+    if max_size_mb is not None:
+        # Count what every shelf uses, then drop the oldest until the rest fit
+        blobs = {}
+        users = {}
+        total = 0
+        for name, created in shelves:
+            blobs[name] = shelf_blobs(name)
+            total += shelf_files_size(name)
+            for digest in blobs[name]:
+                users[digest] = users.get(digest, 0) + 1
+        total += sum(blob_size(x) for x in users)
+
+        for name in doomed:
+            total -= shelf_files_size(name)
+            for digest in blobs[name]:
+                users[digest] -= 1
+                if users[digest] == 0:
+                    total -= blob_size(digest)
+
+        quota = max_size_mb * 1024 * 1024
+        remaining = [ name for name, created in shelves if name not in set(doomed) ]
+        for name in remaining:
+            if total <= quota:
+                break
+            doomed.append(name)
+            total -= shelf_files_size(name)
+            for digest in blobs[name]:
+                users[digest] -= 1
+                if users[digest] == 0:
+                    total -= blob_size(digest)
+
+    if doomed:
+        with db:
+            db.executemany("DELETE FROM shelves WHERE id = ?", [ (int(x),) for x in doomed ])
+            delete_shelves(doomed)
+    print_info("Pruned %d shelves" % len(doomed))
+    lock.close()
 
 
 def do_shelve(target_dir, message):
     print_debug("Shelving", target_dir, message)
 
-    # Get information about SVN repo
-    info = call_svn("info", target_dir)
-    info = dict([ tuple(x.split(': ')) for x in info.strip().splitlines()])
+    # Get information about SVN repo, its status and the patch together. The
+    # patch streams straight into storage, so any size of diff can be shelved.
+    info, changes, manifest = SVN.collect(target_dir, store_patch_stream)
 
-    # Generate patch file based on target
-    diff = call_svn("diff", target_dir)
-    if not diff:
+    if not manifest:
         print "Nothing to shelve"
         return
-    
-    modifiedPaths = re.findall("Index: (.*)", diff)
-    modifiedPaths = [ normpath(x.strip()) for x in modifiedPaths ]
-    modifiedPaths = [ relpath(x, target_dir) for x in modifiedPaths ]
 
-    for path in modifiedPaths:
-        print_info("M\t", path) # TODO: get correct status code
-    print_info("")
+    status = dict((relpath(normpath(path), target_dir), (item, props)) for item, props, path in changes)
 
-    # Generate new shelve location
-    new_id = generate_new_id()
-    storage_path = get_storage_path(new_id)
+    # Index each file's status along with its diff, with property only changes having no item status
+    modifiedPaths = []
+    for entry in manifest:
+        if entry["path"] is None:
+            continue
+        path = relpath(normpath(entry["path"]), target_dir)
+        entry["status"], entry["props"] = status.get(path, ("M", " "))
+        modifiedPaths.append(path)
+        print_info("%s%s%s\t" % (entry["status"], entry["props"], "b" if entry.get("binary") else " "), path)
+    print_info("")
 
-    while os.path.isdir( storage_path ):
-        new_id = generate_new_id()
-        storage_path = get_storage_path(new_id)
-    os.makedirs(storage_path)
+    # Keep the base of modified files so unshelving can merge rather than rely on fuzz
+    modified = [ x for x in manifest if x["path"] is not None and x["status"] == "M" and x["hunks"] ]
+    for entry, digest in zip(modified, SVN.cat_bases([ x["path"] for x in modified ], store_stream)):
+        entry["base"] = digest
 
-    # Generate meta information based on target
+    # Generate meta information based on target, the ID comes with its storage
+    timestamp = time.time()
     meta = {
-        "id": new_id,
+        "id": None,
         "target_dir": target_dir,
-        "local_timestamp": time.ctime(time.time()),
-        "url": info["URL"],
-        "revision": int(info["Revision"]),
+        "timestamp": timestamp,
+        "local_timestamp": time.ctime(timestamp),
+        "url": info["url"],
+        "revision": info["revision"],
         "hostname": socket.gethostname(),
         "username": getpass.getuser(),
         "modified": modifiedPaths,
         "message": message
     }
-    
-    # Write all
-    meta_filename = join(storage_path, "meta")
-    patch_filename = join(storage_path, "patch")
-    
-    file(meta_filename, "wb").write(pickle.dumps(meta))
-    print_debug("Wrote", meta_filename)
-    
-    file(patch_filename, "wb").write(diff)
-    print_debug("Wrote", patch_filename)
+
+    # The blobs are already stored, and may be shared, so only the shelf itself goes through the service
+    service = connect_service()
+    if service:
+        try:
+            new_id = service.call("commit", meta=meta, manifest=manifest)
+        except ServiceError as e:
+            fatal("Shelf service failed to store the shelf:", e)
+    else:
+        new_id = store_shelf(open_catalog(), meta, manifest, generate_new_id)
 
     print_info("Shelved changelist:", new_id)
 
 
 
 
-def do_unshelve(shelve_id, target_dir):
-    print_debug("Unshelving", shelve_id, target_dir)
-    storage_path = get_storage_path(shelve_id)
+def match_only(path, patterns):
+    # Matches a shelved path against --only globs, or the folders holding it
+    path = path.replace("\\", "/")
+    for pattern in patterns:
+        pattern = pattern.replace("\\", "/").rstrip("/")
+        if fnmatch.fnmatch(path, pattern) or path.startswith(pattern + "/"):
+            return True
+    return False
 
-    meta_filename = join(storage_path, "meta")
-    patch_filename = join(storage_path, "patch")
+def do_unshelve(shelve_id, target_dir, only=None, dry_run=False, fuzz=svn_patch.DEFAULT_FUZZ, use_svn_patch=False, merge=True):
+    print_debug("Unshelving", shelve_id, target_dir, only)
+    storage_path = get_storage_path(shelve_id)
 
     try:
-        meta = pickle.loads(open(meta_filename, "rb").read())
-        patch = open(patch_filename, "rb").read()
+        meta = read_meta(storage_path)
+
+        # Pick out just the requested files' diffs
+        entries = None
+        if only:
+            entries = [ x for x in read_shelf_index(storage_path) if x["path"] is not None and
+                        match_only(relpath(normpath(x["path"]), meta["target_dir"]), only) ]
+            if not entries:
+                fatal("No files in %d match %s" % (shelve_id, ", ".join(only)))
+            for entry in entries:
+                print_debug("Selected", entry["path"])
+
+        if use_svn_patch:
+            patch_filename = extract_shelf_patch(storage_path, entries)
+        else:
+            patch = read_shelf_patch(storage_path, entries)
+            get_base = shelf_base_reader(storage_path) if merge else None
     except IOError:
-        fatal("%d is not a valid id")
+        fatal("%d is not a valid id" % shelve_id)
 
-    # Apply patch against target directory
-    # TODO: see if we can suggest a better match
-    print call_svn("patch", patch_filename, target_dir)
+    if use_svn_patch:
+        try:
+            print SVN.patch(patch_filename, target_dir)
+        finally:
+            os.remove(patch_filename)
+        return
+
+    # Apply patch against target directory, at the same paths relative to it as were shelved.
+    # Files whose base was shelved are three-way merged, even if the target has been updated since.
+    results = svn_patch.apply_patch(patch, target_dir, meta["target_dir"], fuzz, dry_run, get_base=get_base)
+
+    # Schedule added and deleted files as svn patch would, then set their properties
+    if not dry_run:
+        added = [ x.path for x in results if x.created and x.applied ]
+        deleted = [ x.path for x in results if x.deleted ]
+        if added:
+            SVN.add(added)
+        if deleted:
+            SVN.remove(deleted)
+    svn_patch.apply_props(results, SVN, fuzz, dry_run)
+
+    print_info(svn_patch.format_report(results, dry_run))
+    if dry_run:
+        return
+
+    # Conflict markers left in files need resolving just as much as rejected hunks
+    if any(x.failed() for x in results):
+        sys.exit(1)
 
 
 def do_info(shelve_id):
     print_debug( "Fetching info", shelve_id )
     storage_path = get_storage_path(shelve_id)
 
-    meta_filename = join(storage_path, "meta")
-    patch_filename = join(storage_path, "patch")
-
     try:
-        meta = pickle.loads(open(meta_filename, "rb").read())
-        patch = open(patch_filename, "rb").read()
+        meta = read_meta(storage_path)
+        index = read_shelf_index(storage_path)
     except IOError:
-        fatal("%d is not a valid id")
+        fatal("%d is not a valid id" % shelve_id)
 
+    # The index lists the modified files, with more detail
     for key, value in meta.iteritems():
-        print_info("%s : %s" % (humanize_key(key), humanize_value(value)))
+        if key != "modified":
+            print_info("%s : %s" % (humanize_key(key), humanize_value(value)))
+
+    # Columns are item status, property status and "b" for binary files, as
+    # far as the shelf recorded them. Shelves indexed before hunks were counted show "?"
+    print_info("")
+    for entry in index:
+        if entry["path"] is not None:
+            flags = entry.get("status", "M") + entry.get("props", " ") + ("b" if entry.get("binary") else " ")
+            print_info("%s\t%4s hunks %10d bytes\t%s" % (flags, entry.get("hunks", "?"), entry["size"],
+                                                         relpath(normpath(entry["path"]), meta["target_dir"])))
     
     
-def _mp_test_proc(procidx):
+def _mp_test_proc(generate):
     global DEBUG
     DEBUG = False # Don't spam the subprocess output while testing
-    new_id = generate_new_id()
-    return new_id
+    new_id = generate()
+    return new_id, os.getpid(), LOCK_WAIT["central"], LOCK_WAIT["local"]
+
+def test_id_scheme(name, generate, gen_max, num_procs):
+    print_info("Testing concurrent distributed ID generation (%s)..." % name)
+
+    pool = multiprocessing.Pool(processes=num_procs)
+    start = time.time()
+    mproc_results = [pool.apply_async(_mp_test_proc, (generate,)) for x in xrange(gen_max)]
+    results = [p.get() for p in mproc_results]
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+
+    all_ids = [x[0] for x in results]
+    is_unique = len(all_ids) == len(set(all_ids))
+    if not is_unique:
+        fatal("Non-unique ID's generated.")
+
+    # Lock waits accumulate per worker process, so take each worker's latest total
+    waits = {}
+    for new_id, pid, central_wait, local_wait in results:
+        last_central, last_local = waits.get(pid, (0.0, 0.0))
+        waits[pid] = (max(last_central, central_wait), max(last_local, local_wait))
+    central_wait = sum(x[0] for x in waits.values())
+    local_wait = sum(x[1] for x in waits.values())
+
+    print_info("...successfully generated %d unique ID's across %d processes." % (gen_max, num_procs))
+    print_info("   %.0f allocations/sec, %.2fs waiting on the central lock, %.2fs on the local lease lock" % (
+        gen_max / elapsed, central_wait, local_wait))
+
+def _mp_service_test_proc(address, index):
+    global DEBUG
+    DEBUG = False
+    start = time.time()
+    service = connect_service(address)
+    if service is None:
+        raise ServiceError("Could not connect to %s" % (address,))
+
+    # Every fourth client lists, the rest shelve
+    new_id = None
+    if index % 4:
+        meta = {"id": None, "target_dir": "", "timestamp": time.time(), "local_timestamp": "", "url": "load-test",
+                "revision": 0, "hostname": socket.gethostname(), "username": "load-test", "modified": [],
+                "message": "Load test %d" % index}
+        new_id = service.call("commit", meta=meta, manifest=[])
+    else:
+        service.call("list", username="load-test", limit=20)
+    service.close()
+    return new_id, time.time() - start
+
+def test_service(num_requests, num_procs):
+    """Load tests a shelf service, run in-process against temporary storage."""
+    print_info("Testing shelf service with concurrent shelve/list clients...")
+    local_storage = CONFIG.local_storage
+    CONFIG.local_storage = tempfile.mkdtemp(prefix="svn_shelve_test_")
+    try:
+        if hasattr(socket, "AF_UNIX"):
+            address = join(CONFIG.local_storage, "service.sock")
+        else:
+            address = ("127.0.0.1", 0)
+        server = create_service_server(address)
+        address = server.server_address
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        pool = multiprocessing.Pool(processes=num_procs)
+        start = time.time()
+        mproc_results = [pool.apply_async(_mp_service_test_proc, (address, x)) for x in xrange(num_requests)]
+        results = [p.get() for p in mproc_results]
+        elapsed = time.time() - start
+        pool.close()
+        pool.join()
+        server.shutdown()
+        server.server_close()
+
+        all_ids = [x[0] for x in results if x[0] is not None]
+        if len(all_ids) != len(set(all_ids)):
+            fatal("Non-unique ID's generated by the shelf service.")
+        latencies = sorted(x[1] for x in results)
+
+        print_info("...handled %d requests (%d shelves) from %d processes." % (num_requests, len(all_ids), num_procs))
+        print_info("   %.0f requests/sec, median latency %.1fms, worst %.1fms" % (
+            num_requests / elapsed, latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000))
+    finally:
+        shutil.rmtree(CONFIG.local_storage, ignore_errors=True)
+        CONFIG.local_storage = local_storage
 
 def do_tests():
     print_info("Testing single ID generation: new_id = %d" % generate_new_id())
     
     gen_max = 10000
     num_procs = 32
-    print_info("Testing concurrent distributed ID generation...")
-    
-    pool = multiprocessing.Pool(processes=num_procs)
-    mproc_results = [pool.apply_async(_mp_test_proc, (x,)) for x in xrange(gen_max)]
-    all_ids = [p.get() for p in mproc_results]
-    is_unique = len(all_ids) == len(set(all_ids))
-
-    if is_unique:
-        print_info("...successfully generated %d unique ID's across %d processes." % (gen_max, num_procs))
-    else:
-        fatal("Non-unique ID's generated.")
+    for name, generate in [("central", generate_central_id), ("leased", generate_new_id)]:
+        test_id_scheme(name, generate, gen_max, num_procs)
 
+    test_service(2000, num_procs)
 
 
 def main():
-    check_environment()
-
     parser = argparse.ArgumentParser()
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("-s", "--shelve", action="store_true")
     group.add_argument("-u", "--unshelve", metavar="ID", default=0, type=int)
     group.add_argument("-i", "--info", metavar="ID", default=0, type=int)
     group.add_argument("-l", "--list", action="store_true")
+    group.add_argument("--reindex", action="store_true", help="Rebuild the shelf catalog from the shelf directories.")
+    group.add_argument("--pack", action="store_true", help="Move shelves older than --older-than days into a pack file.")
+    group.add_argument("--prune", action="store_true", help="Delete shelves beyond --max-age days, or the oldest beyond --max-size MB.")
+    group.add_argument("--serve", action="store_true", help="Run the shelf service, which other svn-shelve's use when they can reach it.")
     group.add_argument("-t", "--test", action="store_true")
     parser.add_argument("-d", "--debug", action="store_true")
+    parser.add_argument("--dry-run", action="store_true", help="With --unshelve, only report what would apply and what would conflict.")
+    parser.add_argument("--fuzz", metavar="N", default=svn_patch.DEFAULT_FUZZ, type=int, help="With --unshelve, context lines which may be ignored to place a change.")
+    parser.add_argument("--no-merge", action="store_true", help="With --unshelve, patch files rather than merging them with their shelved base.")
+    parser.add_argument("--svn-patch", action="store_true", help="With --unshelve, apply the shelf with svn patch rather than the built-in patcher.")
+    parser.add_argument("--no-service", action="store_true", help="Don't use the shelf service even if it's running.")
+    parser.add_argument("--backend", choices=BACKENDS, default="auto", help="Use pysvn in-process or the svn command line client (pysvn when installed by default).")
+    parser.add_argument("--stream-diff", action="store_true", help="With --shelve and the pysvn backend, stream the diff through the svn command line client, which keeps memory use constant for very large changes.")
     parser.add_argument("-m", "--message", metavar="MESSAGE", default="", type=str)
+    parser.add_argument("-o", "--only", metavar="PATH", action="append", help="Only unshelve files matching this path or glob (may be repeated).")
+    parser.add_argument("--all", action="store_true", help="List shelves of all users and hosts.")
+    parser.add_argument("--user", metavar="USER", default=None, type=str, help="List shelves of this user, from any host unless --host is given (current user and host by default).")
+    parser.add_argument("--host", metavar="HOST", default=None, type=str, help="List shelves from this host (current host by default).")
+    parser.add_argument("--url", metavar="URL", default=None, type=str, help="Only list shelves whose URL contains this.")
+    parser.add_argument("--limit", metavar="N", default=None, type=int, help="List at most N shelves.")
+    parser.add_argument("--offset", metavar="N", default=0, type=int, help="Skip the first N shelves (newest first).")
+    parser.add_argument("--older-than", metavar="DAYS", default=90, type=float, help="Age of the shelves to --pack (90 days by default).")
+    parser.add_argument("--max-age", metavar="DAYS", default=None, type=float, help="Oldest shelves to keep when pruning.")
+    parser.add_argument("--max-size", metavar="MB", default=None, type=float, help="Storage to keep shelves within when pruning.")
     parser.add_argument("target_dir", nargs="?", default=os.getcwd(), help="Directory on which to operate (cwd by default).")
     args = parser.parse_args()
 
-    global DEBUG
+    global DEBUG, USE_SERVICE
     DEBUG = args.debug
+    USE_SERVICE = not args.no_service
 
     if not os.path.isabs(args.target_dir):
         args.target_dir = normpath(join(os.getcwd(), args.target_dir))
 
+    if args.shelve or args.unshelve:
+        check_environment(args.backend, args.stream_diff)
+
+    try:
+        run_command(args)
+    except SvnError as e:
+        # svn has already reported the details
+        sys.exit(e.returncode)
+    except IdError as e:
+        fatal(e)
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+
+def run_command(args):
+    if args.serve:
+        do_serve()
     if args.test:
         do_tests()
     if args.list:
-        do_list()
+        username = args.user or (None if args.all else getpass.getuser())
+        hostname = args.host or (None if args.all or args.user else socket.gethostname())
+        do_list(username, hostname, args.url, args.limit, args.offset)
+    if args.reindex:
+        do_reindex()
+    if args.pack:
+        do_pack(args.older_than)
+    if args.prune:
+        do_prune(args.max_age, args.max_size)
     if args.shelve:
         do_shelve(args.target_dir, args.message)
     elif args.unshelve:
-        do_unshelve(args.unshelve, args.target_dir)
+        do_unshelve(args.unshelve, args.target_dir, args.only, args.dry_run, args.fuzz, args.svn_patch, not args.no_merge)
     elif args.info:
         do_info(args.info)
 
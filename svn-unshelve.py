@@ -7,6 +7,9 @@ from pprint import pprint
 from os.path import join, normpath
 
 from svn_shelve_config import CONFIG
+from svn_shelve_storage import get_storage_path, shelf_exists, read_meta, read_shelf_patch, shelf_base_reader
+
+import svn_patch
 
 DEBUG = False
 
@@ -15,8 +18,8 @@ def trace( *args ):
 		print "(DEBUG)", " ".join( [str(x) for x in args] )
 
 def getExistingShelve( id ):
-	storageLocation = join( CONFIG.local_storage, str(id) )
-	if os.path.isdir( storageLocation ):
+	storageLocation = get_storage_path( id )
+	if shelf_exists( id ):
 		return storageLocation
 	else:
 		return None
@@ -31,14 +34,8 @@ def main():
 		return
 
 	trace( "Found shelve %s at %s" % (id, storageLocation) )
-	metaFilename = join(storageLocation, "meta")
-	patchFilename = join(storageLocation, "patch")
-
-	meta = pickle.loads( open( metaFilename, "rb" ).read() )
-	trace( "Read", metaFilename )
-
-	patch = open( patchFilename, "rb" ).read()
-	trace( "Read", patchFilename )
+	meta = read_meta( storageLocation )
+	trace( "Read meta", storageLocation )
 
 	# Just print info and quit?
 	if "-info" in sys.argv:
@@ -56,10 +53,13 @@ def main():
 	# If it doesn't match, ask the user if they really want to try patching anyway
 
 
-	# Apply patch
-	cmd = [ CONFIG.patch_bin, "-s", "--binary", "-i", patchFilename ]
-	trace( "cmd", cmd )
-	subprocess.call( cmd )
+	# Apply patch, to the same paths relative to the current folder as they were shelved from
+	dryRun = "-dry-run" in sys.argv
+	results = svn_patch.apply_patch( read_shelf_patch( storageLocation ), os.getcwd(), meta["target_dir"], dry_run=dryRun,
+		get_base=shelf_base_reader( storageLocation ) )
+	print svn_patch.format_report( results, dryRun )
+	if any( x.failed() for x in results ):
+		sys.exit( 1 )
 
 
 if __name__ == "__main__":
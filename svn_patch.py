@@ -0,0 +1,616 @@
+"""
+Applies unified diffs, as written by svn diff, without an external patch tool.
+
+    svn_patch.py shelf.patch
+    svn_patch.py -d c:/work/trunk --dry-run shelf.patch
+    svn_patch.py --selftest svn_patch_corpus
+
+The patch is parsed once, then each target file is read in one go, has its
+hunks applied in memory, and is written back in one go. Lines end at "\n"
+only, as they do for patch, so a lone "\r" is part of a line. Hunks are
+placed like GNU patch does: at the line they name, else at the nearest
+offset where their context matches, else ignoring up to --fuzz lines of
+context at either end. Hunks which can't be placed are written to
+<file>.rej, or just reported with --dry-run.
+
+Property changes are parsed too, but need Subversion to apply, see
+apply_props(). Without it they are reported as not applied.
+
+Given the base version a file's diff was taken against, the diff is instead
+applied to that base, and the result three-way merged with the current
+file, marking any conflicting changes in the file as svn merge does.
+"""
+import os
+import re
+import sys
+import shutil
+import filecmp
+import argparse
+import difflib
+import tempfile
+import subprocess
+
+from os.path import join, normpath
+
+DEFAULT_FUZZ = 2
+
+HUNK_RE = re.compile(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+PROP_HUNK_RE = re.compile(r"## -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? ##")
+PROP_CHANGE_RE = re.compile(r"(Added|Modified|Deleted|Name): (.+)$")
+PROP_SECTION = "Property changes on: "
+NO_NEWLINE = "\\ No newline at end of file"
+CONFLICT_MARKERS = ("<<<<<<< .working", "||||||| .base", "=======", ">>>>>>> .shelf")
+BINARY_MARKER = "Cannot display: file marked as a binary type."
+
+
+class Hunk(object):
+    def __init__(self, old_start, old_len, new_start, new_len, header):
+        self.old_start = old_start
+        self.old_len = old_len
+        self.new_start = new_start
+        self.new_len = new_len
+        self.header = header
+        self.lines = [] # Diff lines including their ' ', '-' or '+'
+
+    def old_lines(self):
+        return [ x[1:] for x in self.lines if x[0] in " -" ]
+
+    def new_lines(self):
+        return [ x[1:] for x in self.lines if x[0] in " +" ]
+
+    def leading_context(self):
+        count = 0
+        while count < len(self.lines) and self.lines[count][0] == " ":
+            count += 1
+        return count
+
+    def trailing_context(self):
+        count = 0
+        while count < len(self.lines) and self.lines[-1 - count][0] == " ":
+            count += 1
+        return count
+
+    def text(self):
+        # The hunk as it appeared in the patch, for .rej files
+        lines = [self.header]
+        for line in self.lines:
+            if line.endswith("\n"):
+                lines.append(line)
+            else:
+                lines.append(line + "\n" + NO_NEWLINE + "\n")
+        return "".join(lines)
+
+
+class PropPatch(object):
+    # A property's change, with hunks over the lines of its value
+    def __init__(self, name, action):
+        self.name = name
+        self.action = action # Added, Modified or Deleted
+        self.hunks = []
+
+
+class FilePatch(object):
+    def __init__(self, path):
+        self.path = path
+        self.hunks = []
+        self.props = [] # PropPatch per changed property
+        self.binary = False
+
+    def is_new_file(self):
+        return len(self.hunks) == 1 and self.hunks[0].old_start == 0 and self.hunks[0].old_len == 0
+
+    def is_deleted_file(self):
+        return len(self.hunks) == 1 and self.hunks[0].new_start == 0 and self.hunks[0].new_len == 0
+
+
+def split_lines(data):
+    """Splits data into lines ending in "\n", keeping their line endings, as readline does."""
+    lines = data.split("\n")
+    last = lines.pop()
+    lines = [ x + "\n" for x in lines ]
+    if last:
+        lines.append(last)
+    return lines
+
+def strip_header_path(line):
+    # "--- path\t(revision 123)" -> "path"
+    return line[4:].split("\t")[0].rstrip("\r\n")
+
+def parse_hunk(header, match, lines, i):
+    """Reads the lines of the hunk whose header matched, returning it and the index after it."""
+    old_start, old_len, new_start, new_len = match.groups()
+    hunk = Hunk(int(old_start), int(old_len) if old_len is not None else 1,
+                int(new_start), int(new_len) if new_len is not None else 1, header)
+
+    # Hunk lines are counted, so anything after them (e.g. property changes) is left alone
+    old_remaining, new_remaining = hunk.old_len, hunk.new_len
+    while i < len(lines) and (old_remaining > 0 or new_remaining > 0 or lines[i].startswith("\\")):
+        line = lines[i]
+        i += 1
+        if line.startswith("\\"):
+            # The previous line has no newline at the end of the file (or property)
+            if hunk.lines:
+                hunk.lines[-1] = hunk.lines[-1].rstrip("\r\n")
+            continue
+        if line in ("\n", "\r\n"):
+            line = " " + line # Context line whose trailing space was lost
+        kind = line[0]
+        if kind == " ":
+            old_remaining -= 1
+            new_remaining -= 1
+        elif kind == "-":
+            old_remaining -= 1
+        elif kind == "+":
+            new_remaining -= 1
+        else:
+            i -= 1
+            break
+        hunk.lines.append(line)
+    return hunk, i
+
+def parse_patch(data):
+    """Parses a unified diff into a FilePatch per file, in order."""
+    patches = []
+    current = None
+    prop = None # Property whose changes are being read, in a property section
+    in_props = False
+    lines = split_lines(data)
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+
+        if line.startswith("Index: "):
+            current = FilePatch(line[7:].rstrip("\r\n"))
+            patches.append(current)
+            prop, in_props = None, False
+        elif line.startswith("--- ") and i < len(lines) and lines[i].startswith("+++ "):
+            # Plain unified diffs have no Index line, so the headers name the file
+            if current is None or current.hunks or current.props:
+                current = FilePatch(strip_header_path(lines[i]))
+                patches.append(current)
+            prop, in_props = None, False
+            i += 1
+        elif line.startswith(PROP_SECTION):
+            # Follows the file's own changes, or stands alone for e.g. a folder
+            path = line[len(PROP_SECTION):].rstrip("\r\n")
+            if current is None or current.path != path:
+                current = FilePatch(path)
+                patches.append(current)
+            prop, in_props = None, True
+        elif in_props and PROP_CHANGE_RE.match(line.rstrip("\r\n")):
+            action, name = PROP_CHANGE_RE.match(line.rstrip("\r\n")).groups()
+            prop = PropPatch(name, action)
+            current.props.append(prop)
+        elif line.startswith("## ") and prop is not None:
+            match = PROP_HUNK_RE.match(line)
+            if match:
+                hunk, i = parse_hunk(line, match, lines, i)
+                prop.hunks.append(hunk)
+        elif line.startswith(BINARY_MARKER) and current is not None:
+            current.binary = True
+        elif line.startswith("@@ ") and current is not None:
+            match = HUNK_RE.match(line)
+            if match:
+                hunk, i = parse_hunk(line, match, lines, i)
+                current.hunks.append(hunk)
+
+    return patches
+
+
+def read_lines(path):
+    """Reads a file as a list of lines with their line endings, in one go."""
+    with open(path, "rb") as fp:
+        return split_lines(fp.read())
+
+def write_lines(path, lines):
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent)
+    with open(path, "wb") as fp:
+        fp.write("".join(lines))
+
+
+def lines_match(lines, pos, expected, ignore_eol):
+    if pos < 0 or pos + len(expected) > len(lines):
+        return False
+    if not ignore_eol:
+        return lines[pos:pos + len(expected)] == expected
+    for a, b in zip(lines[pos:pos + len(expected)], expected):
+        if a.rstrip("\r\n") != b.rstrip("\r\n"):
+            return False
+    return True
+
+def find_hunk(lines, expected, pos, min_pos, ignore_eol):
+    """Finds expected in lines nearest to pos, but not before min_pos."""
+    if not expected:
+        return max(min(pos, len(lines)), min_pos)
+
+    for distance in xrange(0, max(pos, len(lines) - pos) + 1):
+        if pos + distance >= min_pos and lines_match(lines, pos + distance, expected, ignore_eol):
+            return pos + distance
+        if distance and pos - distance >= min_pos and lines_match(lines, pos - distance, expected, ignore_eol):
+            return pos - distance
+    return None
+
+def place_hunk(lines, hunk, pos, min_pos, max_fuzz):
+    """
+    Finds where a hunk applies, returning (position, fuzz, old lines, new lines),
+    or None. With fuzz, up to that many context lines are dropped from each end.
+    """
+    old_lines = hunk.old_lines()
+    new_lines = hunk.new_lines()
+    leading = hunk.leading_context()
+    trailing = hunk.trailing_context()
+
+    for fuzz in xrange(0, max_fuzz + 1):
+        top = min(fuzz, leading)
+        bottom = min(fuzz, trailing)
+        if fuzz and top == 0 and bottom == 0:
+            break
+        if top + bottom >= len(old_lines) and old_lines:
+            break
+
+        trimmed_old = old_lines[top:len(old_lines) - bottom]
+        trimmed_new = new_lines[top:len(new_lines) - bottom]
+        for ignore_eol in (False, True):
+            found = find_hunk(lines, trimmed_old, pos + top, min_pos, ignore_eol)
+            if found is not None:
+                return found, fuzz, trimmed_old, trimmed_new
+    return None
+
+
+def patch_lines(lines, file_patch, max_fuzz):
+    """Applies a file's hunks to its lines, returning (output, applied hunks, rejected hunks)."""
+    applied = [] # (hunk, line offset, fuzz)
+    rejected = []
+    output = []
+    copied = 0 # Lines of the original copied to output so far
+    delta = 0 # How far hunks have been found from where they said
+    for hunk in file_patch.hunks:
+        expected = max(hunk.old_start - 1, 0) if hunk.old_len else hunk.old_start
+        placed = place_hunk(lines, hunk, expected + delta, copied, max_fuzz)
+        if placed is None:
+            rejected.append(hunk)
+            continue
+
+        pos, fuzz, old_lines, new_lines = placed
+        offset = pos - (expected + min(fuzz, hunk.leading_context()))
+        delta += offset
+        applied.append((hunk, offset, fuzz))
+
+        output.extend(lines[copied:pos])
+        output.extend(new_lines)
+        copied = pos + len(old_lines)
+    output.extend(lines[copied:])
+    return output, applied, rejected
+
+
+def sync_regions(base, mine, theirs):
+    """
+    Returns the regions where base, mine and theirs all match, as
+    (base start, base end, mine start, mine end, theirs start, theirs end),
+    ending with an empty region at the end of each.
+    """
+    mine_blocks = difflib.SequenceMatcher(None, base, mine, autojunk=False).get_matching_blocks()
+    theirs_blocks = difflib.SequenceMatcher(None, base, theirs, autojunk=False).get_matching_blocks()
+
+    regions = []
+    i = j = 0
+    while i < len(mine_blocks) and j < len(theirs_blocks):
+        mine_base, mine_start, mine_len = mine_blocks[i]
+        theirs_base, theirs_start, theirs_len = theirs_blocks[j]
+
+        start = max(mine_base, theirs_base)
+        end = min(mine_base + mine_len, theirs_base + theirs_len)
+        if start < end:
+            regions.append((start, end,
+                            mine_start + start - mine_base, mine_start + end - mine_base,
+                            theirs_start + start - theirs_base, theirs_start + end - theirs_base))
+
+        if mine_base + mine_len < theirs_base + theirs_len:
+            i += 1
+        else:
+            j += 1
+
+    regions.append((len(base), len(base), len(mine), len(mine), len(theirs), len(theirs)))
+    return regions
+
+def merge3(base, mine, theirs):
+    """
+    Three-way merges lists of lines, returning the merged lines and the
+    number of conflicts, which are marked in them. Lines are compared
+    ignoring their line endings, and unchanged lines are taken from mine.
+    """
+    key = lambda lines: [ x.rstrip("\r\n") for x in lines ]
+    base_keys, mine_keys, theirs_keys = key(base), key(mine), key(theirs)
+
+    # Where base has other line endings than mine (e.g. svn:eol-style native), give theirs mine's
+    eol = lambda lines: "\r\n" if lines and lines[0].endswith("\r\n") else "\n"
+    if base and mine and eol(base) != eol(mine):
+        theirs = [ x[:-len(eol(base))] + eol(mine) if x.endswith(eol(base)) else x for x in theirs ]
+
+    merged = []
+    conflicts = 0
+    b = m = t = 0
+    for base_start, base_end, mine_start, mine_end, theirs_start, theirs_end in sync_regions(base_keys, mine_keys, theirs_keys):
+        if mine_start > m or theirs_start > t:
+            if mine_keys[m:mine_start] == theirs_keys[t:theirs_start] or base_keys[b:base_start] == theirs_keys[t:theirs_start]:
+                merged.extend(mine[m:mine_start])
+            elif base_keys[b:base_start] == mine_keys[m:mine_start]:
+                merged.extend(theirs[t:theirs_start])
+            else:
+                conflicts += 1
+                for marker, lines in zip(CONFLICT_MARKERS, [mine[m:mine_start], base[b:base_start], theirs[t:theirs_start], []]):
+                    if merged and not merged[-1].endswith("\n"):
+                        merged[-1] += eol(mine)
+                    merged.append(marker + eol(mine))
+                    merged.extend(lines)
+
+        merged.extend(mine[mine_start:mine_end])
+        b, m, t = base_end, mine_end, theirs_end
+
+    return merged, conflicts
+
+
+class FileResult(object):
+    def __init__(self, path):
+        self.path = path
+        self.applied = [] # (hunk, line offset, fuzz)
+        self.rejected = []
+        self.created = False
+        self.deleted = False
+        self.merged = False
+        self.conflicts = 0 # Conflicts marked in the file by a merge
+        self.skipped = None # Reason the file wasn't patched at all
+        self.pending_props = [] # PropPatch's left for apply_props()
+        self.applied_props = [] # Names of the properties changed
+        self.rejected_props = []
+
+    def failed(self):
+        # Anything which still needs resolving by hand
+        return bool(self.rejected or self.conflicts or self.pending_props or self.rejected_props)
+
+def merge_file_patch(file_patch, path, base, result):
+    """
+    Applies a file's hunks to its base, then merges that with the file at
+    path. Returns the merged lines, or None if the hunks don't apply to the
+    base exactly.
+    """
+    base_lines = split_lines(base)
+    theirs, applied, rejected = patch_lines(base_lines, file_patch, 0)
+    if rejected:
+        return None
+
+    mine = read_lines(path)
+    if mine == base_lines:
+        merged, conflicts = theirs, 0
+    else:
+        merged, conflicts = merge3(base_lines, mine, theirs)
+
+    result.merged = True
+    result.conflicts = conflicts
+    result.applied = applied
+    return merged
+
+def apply_file_patch(file_patch, path, max_fuzz=DEFAULT_FUZZ, dry_run=False, reject=True, base=None):
+    """
+    Applies one file's hunks to the file at path, returning a FileResult.
+    Given the base the diff was taken against, the change is merged instead.
+    """
+    result = FileResult(path)
+    result.pending_props = list(file_patch.props)
+    if file_patch.binary:
+        result.skipped = "binary file"
+        return result
+    if not file_patch.hunks:
+        if not file_patch.props:
+            result.skipped = "no changes"
+        return result
+
+    exists = os.path.isfile(path)
+    if not exists and not file_patch.is_new_file():
+        result.skipped = "file not found"
+        result.rejected = list(file_patch.hunks)
+    else:
+        output = None
+        if base is not None and exists and not file_patch.is_new_file() and not file_patch.is_deleted_file():
+            output = merge_file_patch(file_patch, path, base, result)
+        if output is None:
+            output, result.applied, result.rejected = patch_lines(read_lines(path) if exists else [], file_patch, max_fuzz)
+
+        result.created = not exists
+        result.deleted = file_patch.is_deleted_file() and not result.rejected and not output
+        if not dry_run and result.applied:
+            if result.deleted:
+                os.remove(path)
+            else:
+                write_lines(path, output)
+
+    # A missing file is only reported, its folder may not even exist for a .rej
+    if result.rejected and reject and not dry_run and not result.skipped:
+        with open(path + ".rej", "wb") as fp:
+            fp.write("--- %s\n+++ %s\n" % (file_patch.path, file_patch.path))
+            for hunk in result.rejected:
+                fp.write(hunk.text())
+    return result
+
+
+def apply_props(results, svn, max_fuzz=DEFAULT_FUZZ, dry_run=False):
+    """
+    Applies the property changes left on results by apply_patch, through an
+    svn backend's propget, propset and propdel (see svn_shelve_backend). Added
+    files need to be under version control first. Each property's hunks are
+    applied to the lines of its current value.
+    """
+    for result in results:
+        for prop_patch in result.pending_props:
+            if result.deleted:
+                continue # Went with the file
+
+            exists = os.path.exists(result.path)
+            placed = None
+            if prop_patch.hunks and (exists or dry_run):
+                current = svn.propget(result.path, prop_patch.name) if exists else None
+                placed = patch_lines(split_lines(current or ""), prop_patch, max_fuzz)
+            if placed is None or placed[2]:
+                result.rejected_props.append(prop_patch.name)
+                continue
+
+            if not dry_run:
+                if prop_patch.action == "Deleted":
+                    svn.propdel(result.path, prop_patch.name)
+                else:
+                    svn.propset(result.path, prop_patch.name, "".join(placed[0]))
+            result.applied_props.append(prop_patch.name)
+        result.pending_props = []
+
+
+def resolve_path(path, target_dir, strip_prefix):
+    # Paths under strip_prefix (e.g. where a shelf was taken from) are moved under target_dir
+    path = normpath(path)
+    if strip_prefix:
+        prefix = normpath(strip_prefix)
+        if os.path.normcase(path).startswith(os.path.normcase(prefix) + os.sep):
+            path = path[len(prefix) + 1:]
+        elif os.path.normcase(path) == os.path.normcase(prefix):
+            path = ""
+    return join(target_dir, path)
+
+def apply_patch(data, target_dir=".", strip_prefix=None, max_fuzz=DEFAULT_FUZZ, dry_run=False, reject=True, get_base=None):
+    """
+    Applies a patch given as a string, returning a FileResult per file.
+    get_base may return the base content for a path in the patch, or None.
+    """
+    results = []
+    for file_patch in parse_patch(data):
+        path = resolve_path(file_patch.path, target_dir, strip_prefix)
+        base = get_base(file_patch.path) if get_base else None
+        results.append(apply_file_patch(file_patch, path, max_fuzz, dry_run, reject, base))
+    return results
+
+def format_report(results, dry_run=False):
+    """Summarizes what was (or with dry_run, would be) done to each file."""
+    lines = []
+    for result in results:
+        if result.skipped and not result.rejected:
+            lines.append("Skipped\t%s (%s)" % (result.path, result.skipped))
+        else:
+            action = "A" if result.created else "D" if result.deleted else "G" if result.merged else "U"
+            if result.rejected or result.conflicts or result.rejected_props:
+                action = "C"
+            lines.append("%s\t%s" % (action, result.path))
+            for hunk, offset, fuzz in result.applied:
+                if offset or fuzz:
+                    lines.append("\t> applied hunk @@ -%d,%d +%d,%d @@ with offset %d and fuzz %d" % (
+                        hunk.old_start, hunk.old_len, hunk.new_start, hunk.new_len, offset, fuzz))
+            if result.conflicts:
+                lines.append("\t> %d conflict(s) %s" % (result.conflicts, "would be marked" if dry_run else "marked in the file"))
+            for hunk in result.rejected:
+                lines.append("\t> %s hunk @@ -%d,%d +%d,%d @@%s" % (
+                    "would reject" if dry_run else "rejected", hunk.old_start, hunk.old_len, hunk.new_start, hunk.new_len,
+                    " (%s)" % result.skipped if result.skipped else ""))
+        for name in result.applied_props:
+            lines.append("\t> %s property %s" % ("would apply" if dry_run else "applied", name))
+        for name in result.rejected_props:
+            lines.append("\t> %s property %s" % ("would reject" if dry_run else "rejected", name))
+        for prop_patch in result.pending_props:
+            lines.append("\t> property %s not applied (needs svn)" % prop_patch.name)
+
+    conflicts = sum(1 for x in results if x.rejected)
+    if conflicts:
+        has_rej = not dry_run and any(x.rejected and not x.skipped for x in results)
+        lines.append("%d file(s) with rejected hunks%s" % (conflicts, ", see the .rej files" if has_rej else ""))
+    merge_conflicts = sum(1 for x in results if x.conflicts)
+    if merge_conflicts:
+        lines.append("%d file(s) with merge conflicts" % merge_conflicts)
+    prop_failures = sum(1 for x in results if x.rejected_props or x.pending_props)
+    if prop_failures:
+        lines.append("%d file(s) with property changes not applied" % prop_failures)
+    return "\n".join(lines)
+
+
+def compare_trees(a, b):
+    """Returns the relative paths whose content differs between two folders."""
+    differences = []
+    for root, dirs, files in os.walk(a):
+        for filename in files:
+            rel = os.path.relpath(join(root, filename), a)
+            other = join(b, rel)
+            if not os.path.isfile(other) or not filecmp.cmp(join(root, filename), other, shallow=False):
+                differences.append(rel)
+    for root, dirs, files in os.walk(b):
+        for filename in files:
+            rel = os.path.relpath(join(root, filename), b)
+            if not os.path.isfile(join(a, rel)):
+                differences.append(rel)
+    return sorted(set(differences))
+
+def selftest(corpus_dir, patch_bin):
+    """
+    Checks results match patch_bin byte for byte. Each folder in the corpus
+    holds a "patch" and a "before" tree to apply it to, with paths relative
+    to that tree. The corpus in svn_patch_corpus covers offsets, fuzz, missing
+    newlines, CRLF and lone CR line endings, added and deleted files,
+    rejected hunks and files whose folder is missing.
+    """
+    failures = 0
+    for case in sorted(os.listdir(corpus_dir)):
+        patch_filename = join(corpus_dir, case, "patch")
+        if not os.path.isfile(patch_filename):
+            continue
+
+        work_dir = tempfile.mkdtemp(prefix="svn_patch_test_")
+        try:
+            expected_dir = join(work_dir, "expected")
+            actual_dir = join(work_dir, "actual")
+            shutil.copytree(join(corpus_dir, case, "before"), expected_dir)
+            shutil.copytree(join(corpus_dir, case, "before"), actual_dir)
+
+            # -f, so patch skips missing files rather than asking which to patch
+            with open(os.devnull, "r+b") as null:
+                subprocess.call([patch_bin, "-s", "-f", "--binary", "-p0", "-E", "-i", os.path.abspath(patch_filename)],
+                                cwd=expected_dir, stdin=null, stdout=null, stderr=null)
+            apply_patch(open(patch_filename, "rb").read(), actual_dir, reject=False)
+
+            # .orig and .rej files are named and formatted differently by each tool
+            for root, dirs, files in os.walk(expected_dir):
+                for filename in files:
+                    if filename.endswith((".orig", ".rej")):
+                        os.remove(join(root, filename))
+
+            differences = compare_trees(expected_dir, actual_dir)
+            if differences:
+                failures += 1
+                print "FAIL %s: %s" % (case, ", ".join(differences))
+            else:
+                print "ok   %s" % case
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply a unified diff, as written by svn diff")
+    parser.add_argument("patch", help="Patch file to apply (or corpus folder with --selftest).")
+    parser.add_argument("-d", "--directory", default=".", help="Folder to apply the patch in (cwd by default).")
+    parser.add_argument("--strip-prefix", default=None, help="Apply paths under this folder relative to --directory instead.")
+    parser.add_argument("-F", "--fuzz", default=DEFAULT_FUZZ, type=int, help="Context lines which may be ignored when placing a hunk.")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would apply and conflict, without changing files.")
+    parser.add_argument("--no-reject", action="store_true", help="Don't write .rej files for hunks which fail.")
+    parser.add_argument("--selftest", action="store_true", help="Compare results against --patch-bin over a corpus of patches.")
+    parser.add_argument("--patch-bin", default="patch", help="patch tool to compare against with --selftest.")
+    args = parser.parse_args()
+
+    if args.selftest:
+        sys.exit(1 if selftest(args.patch, args.patch_bin) else 0)
+
+    results = apply_patch(open(args.patch, "rb").read(), args.directory, args.strip_prefix,
+                          args.fuzz, args.dry_run, not args.no_reject)
+    print format_report(results, args.dry_run)
+    if any(x.failed() for x in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+"""
+Subversion backends for svn-shelve.
+
+PysvnBackend works in-process through pysvn, avoiding a process launch per
+svn command, and CliBackend drives the svn command line client. Both give
+the same results, so either may be picked with create_backend to compare
+them; "auto" prefers pysvn when it's installed. pysvn can only return a
+diff as one string, so for very large changes PysvnBackend can be asked
+(stream_diff, --stream-diff) to stream just the diff through the command
+line client, which keeps memory use constant at the cost of one process.
+"""
+import os
+import sys
+import base64
+import shutil
+import threading
+import tempfile
+import StringIO
+import contextlib
+import subprocess
+import multiprocessing.pool
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+try:
+    import pysvn
+except ImportError:
+    pysvn = None
+
+BACKENDS = ["auto", "pysvn", "cli"]
+CAT_JOBS = 8 # svn cat processes run at once when fetching bases
+
+# Status codes for the item and props attributes of svn status --xml
+XML_STATUS_CODES = {
+    "none": " ",
+    "normal": " ",
+    "added": "A",
+    "deleted": "D",
+    "modified": "M",
+    "replaced": "R",
+    "conflicted": "C",
+    "missing": "!",
+    "unversioned": "?",
+    "ignored": "I",
+    "external": "X",
+    "obstructed": "~",
+    "incomplete": "!",
+}
+
+
+class SvnError(Exception):
+    def __init__(self, message, returncode=1):
+        Exception.__init__(self, message)
+        self.returncode = returncode
+
+
+def run_concurrently(*calls):
+    """Runs each function in a thread of its own, returning their results in order."""
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+    def run(i):
+        try:
+            results[i] = calls[i]()
+        except BaseException:
+            errors[i] = sys.exc_info()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(calls))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Only raise once everything has finished, so nothing is left running
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
+def map_concurrently(func, items, jobs):
+    """Returns func(item) for each item, running up to jobs at once."""
+    if len(items) < 2:
+        return [ func(x) for x in items ]
+
+    pool = multiprocessing.pool.ThreadPool(min(jobs, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class CliBackend(object):
+    name = "cli"
+
+    def call(self, *args):
+        try:
+            return subprocess.check_output(["svn"] + list(args))
+        except subprocess.CalledProcessError as e:
+            # stderr gets directed out to user already
+            raise SvnError("svn %s failed" % args[0], e.returncode)
+        except OSError:
+            raise SvnError("Subversion not found on system path")
+
+    def version(self):
+        return self.call("--version", "--quiet").strip()
+
+    def info(self, target):
+        """Returns the URL and revision of a working copy."""
+        info = dict(x.split(": ", 1) for x in self.call("info", target).strip().splitlines() if ": " in x)
+        return {"url": info["URL"], "revision": int(info["Revision"])}
+
+    @contextlib.contextmanager
+    def stream(self, *args):
+        """Yields a file to stream an svn command's output from."""
+        try:
+            proc = subprocess.Popen(["svn"] + list(args), stdout=subprocess.PIPE)
+        except OSError:
+            raise SvnError("Subversion not found on system path")
+
+        try:
+            yield proc.stdout
+        except:
+            proc.kill()
+            proc.wait()
+            raise
+
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise SvnError("svn %s failed" % args[0], proc.returncode)
+
+    def diff(self, target):
+        """Yields a file to stream the working copy's diff from."""
+        return self.stream("diff", target)
+
+    def cat_base(self, path):
+        """Yields a file to stream the pristine base of a file from, which needs no server."""
+        return self.stream("cat", "-r", "BASE", path)
+
+    def cat_bases(self, paths, read_base):
+        """Returns read_base(base file) for each path, fetching several at once."""
+        def cat(path):
+            with self.cat_base(path) as fp:
+                return read_base(fp)
+        return map_concurrently(cat, paths, CAT_JOBS)
+
+    def status(self, target):
+        """Returns (item status, property status, path) for each changed path."""
+        changes = []
+        with self.stream("status", "--xml", "--ignore-externals", target) as fp:
+            # Parse entries as they stream in, rather than building the whole document
+            for event, elem in ElementTree.iterparse(fp):
+                if elem.tag != "entry":
+                    continue
+                wc_status = elem.find("wc-status")
+                item = XML_STATUS_CODES.get(wc_status.get("item"), " ")
+                props = XML_STATUS_CODES.get(wc_status.get("props"), " ")
+                if item != " " or props != " ":
+                    changes.append((item, props, elem.get("path")))
+                elem.clear()
+        return changes
+
+    def collect(self, target, read_diff):
+        """
+        Returns the info, status and read_diff(diff file) of a working copy.
+        Each is a separate svn process, so they all run at once.
+        """
+        def diff():
+            with self.diff(target) as fp:
+                return read_diff(fp)
+        return run_concurrently(lambda: self.info(target), lambda: self.status(target), diff)
+
+    def patch(self, patch_filename, target):
+        return self.call("patch", patch_filename, target)
+
+    def add(self, paths):
+        return self.call("add", "--parents", *paths)
+
+    def remove(self, paths):
+        return self.call("delete", *paths)
+
+    def propget(self, path, name):
+        """Returns the value of a property, or None if it isn't set."""
+        # proplist rather than propget, which fails on a missing property in newer clients
+        value = None
+        with self.stream("proplist", "--xml", "--verbose", path) as fp:
+            for event, elem in ElementTree.iterparse(fp):
+                if elem.tag == "property" and elem.get("name") == name:
+                    if elem.get("encoding") == "base64":
+                        value = base64.b64decode(elem.text or "")
+                    else:
+                        value = (elem.text or "").encode("utf-8")
+        return value
+
+    def propset(self, path, name, value):
+        # Values may span lines or hold anything, so they go through a file
+        fd, value_filename = tempfile.mkstemp(prefix="svn_shelve_")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(value)
+            return self.call("propset", name, "-F", value_filename, path)
+        finally:
+            os.remove(value_filename)
+
+    def propdel(self, path, name):
+        return self.call("propdel", name, path)
+
+
+class PysvnBackend(object):
+    name = "pysvn"
+
+    STATUS_CODES = {}
+    if pysvn is not None:
+        STATUS_CODES = {
+            pysvn.wc_status_kind.none: " ",
+            pysvn.wc_status_kind.normal: " ",
+            pysvn.wc_status_kind.added: "A",
+            pysvn.wc_status_kind.deleted: "D",
+            pysvn.wc_status_kind.modified: "M",
+            pysvn.wc_status_kind.replaced: "R",
+            pysvn.wc_status_kind.conflicted: "C",
+            pysvn.wc_status_kind.missing: "!",
+            pysvn.wc_status_kind.unversioned: "?",
+            pysvn.wc_status_kind.ignored: "I",
+            pysvn.wc_status_kind.external: "X",
+            pysvn.wc_status_kind.obstructed: "~",
+            pysvn.wc_status_kind.incomplete: "!",
+        }
+
+    def __init__(self, stream_diff=False):
+        self.client = pysvn.Client()
+        self.cli = CliBackend() if stream_diff else None # Only used to stream diffs
+
+    @contextlib.contextmanager
+    def errors(self):
+        # Reports pysvn errors the way the svn client would, on stderr
+        try:
+            yield
+        except pysvn.ClientError as e:
+            sys.stderr.write("svn: %s\n" % e.args[0])
+            raise SvnError(e.args[0])
+
+    def version(self):
+        return ".".join(str(x) for x in pysvn.svn_version[:3])
+
+    def info(self, target):
+        with self.errors():
+            path, info = self.client.info2(target, recurse=False)[0]
+        return {"url": info["URL"], "revision": info["rev"].number}
+
+    def diff(self, target):
+        if self.cli is not None:
+            return self.cli.diff(target)
+        return self.diff_buffered(target)
+
+    @contextlib.contextmanager
+    def diff_buffered(self, target):
+        # pysvn hands back the diff as a string, so there is nothing to stream
+        temp_dir = tempfile.mkdtemp(prefix="svn_shelve_")
+        try:
+            with self.errors():
+                diff = self.client.diff(temp_dir, target)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        yield StringIO.StringIO(diff)
+
+    def cat_bases(self, paths, read_base):
+        # Bases come from the pristine store in-process, without a server or
+        # a process per file. One client can't be shared between threads, so
+        # these run in turn.
+        results = []
+        for path in paths:
+            with self.cat_base(path) as fp:
+                results.append(read_base(fp))
+        return results
+
+    @contextlib.contextmanager
+    def cat_base(self, path):
+        with self.errors():
+            content = self.client.cat(path, revision=pysvn.Revision(pysvn.opt_revision_kind.base))
+        yield StringIO.StringIO(content)
+
+    def status(self, target):
+        with self.errors():
+            entries = self.client.status(target, recurse=True, get_all=False, ignore_externals=True)
+
+        changes = []
+        for entry in entries:
+            item = self.STATUS_CODES.get(entry.text_status, " ")
+            props = self.STATUS_CODES.get(entry.prop_status, " ")
+            if item != " " or props != " ":
+                changes.append((item, props, entry.path))
+        changes.sort(key=lambda x: x[2])
+        return changes
+
+    def collect(self, target, read_diff):
+        # A pysvn client may only be used by one thread at a time, so info
+        # and status run in turn, alongside the diff when it's a process
+        def diff():
+            with self.diff(target) as fp:
+                return read_diff(fp)
+        def info_status():
+            return self.info(target), self.status(target)
+
+        if self.cli is None:
+            (info, changes), diff_result = info_status(), diff()
+        else:
+            (info, changes), diff_result = run_concurrently(info_status, diff)
+        return info, changes, diff_result
+
+    def patch(self, patch_filename, target):
+        output = []
+        def notify(event):
+            output.append("%s  %s" % (event["action"], event["path"]))
+
+        self.client.callback_notify = notify
+        try:
+            with self.errors():
+                self.client.patch(patch_filename, target)
+        finally:
+            self.client.callback_notify = None
+        return "\n".join(output)
+
+    def add(self, paths):
+        with self.errors():
+            self.client.add(paths, add_parents=True)
+
+    def remove(self, paths):
+        with self.errors():
+            self.client.remove(paths)
+
+    def propget(self, path, name):
+        with self.errors():
+            values = self.client.propget(name, path)
+        return values.values()[0] if values else None
+
+    def propset(self, path, name, value):
+        with self.errors():
+            self.client.propset(name, value, path)
+
+    def propdel(self, path, name):
+        with self.errors():
+            self.client.propdel(name, path)
+
+
+def create_backend(name="auto", stream_diff=False):
+    if name == "auto":
+        name = "pysvn" if pysvn is not None else "cli"
+
+    if name == "pysvn":
+        if pysvn is None:
+            raise SvnError("pysvn is not installed")
+        return PysvnBackend(stream_diff)
+    return CliBackend()
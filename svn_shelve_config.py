@@ -3,4 +3,5 @@ from os.path import normpath
 class CONFIG:
 	patch_bin = normpath("d:/cygwin64/bin/patch.exe")
 	local_storage = normpath("C:/_shelved")
-
+	# Unix socket path or (host, port) of the shelf service; None picks a default
+	service_address = None
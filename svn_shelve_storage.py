@@ -0,0 +1,630 @@
+"""
+Shelf storage shared by svn-shelve and svn-unshelve.
+
+A shelf's patch is split into one diff per file, and each of those is stored
+once as a zlib compressed blob named by the sha1 of its content, under
+.blobs in the shelf storage. The shelf keeps a manifest listing its blobs in
+order, so identical file diffs shelved any number of times cost one blob.
+The base versions modified files were diffed against are stored as blobs
+too, so they're shared across every shelf of the same revision.
+Shelves written before this layout keep a plain "patch" file, which is still
+read as-is.
+
+Old shelves may be packed, moving their files and the blobs only they use
+into an append-only pack file under .packs, alongside an index of where
+each one lies. Reads look for loose files first and fall back to the packs,
+so callers needn't know which layout a shelf is in.
+"""
+import os
+import re
+import zlib
+import time
+import errno
+import pickle
+import shutil
+import hashlib
+import tempfile
+
+from os.path import join
+
+from svn_shelve_config import CONFIG
+
+META_FILENAME = "meta"
+PATCH_FILENAME = "patch"
+MANIFEST_FILENAME = "manifest"
+SHELF_FILENAMES = [META_FILENAME, MANIFEST_FILENAME, PATCH_FILENAME]
+BLOBS_DIRNAME = ".blobs"
+PACKS_DIRNAME = ".packs"
+PACK_SUFFIX = ".pack"
+PACK_INDEX_SUFFIX = ".idx"
+BLOB_GRACE_PERIOD = 60 * 60 # Unreferenced loose blobs younger than this may belong to a shelve in progress
+COMPRESS_LEVEL = 6
+READ_SIZE = 64 * 1024 # Longest piece of a diff line read at once while streaming
+
+BINARY_MARKER = "Cannot display: file marked as a binary type."
+INDEX_RE = re.compile(r"Index: (.*)")
+
+
+def get_storage_path(id):
+    return join(CONFIG.local_storage, str(id))
+
+def get_blob_path(digest):
+    return join(CONFIG.local_storage, BLOBS_DIRNAME, digest[:2], digest[2:])
+
+def get_packs_dir():
+    return join(CONFIG.local_storage, PACKS_DIRNAME)
+
+
+class SubFile(object):
+    """Read-only view of size bytes of fp starting at start, for files stored in a pack."""
+    def __init__(self, fp, start, size):
+        self.fp = fp
+        self.start = start
+        self.size = size
+        self.pos = 0
+        fp.seek(start)
+
+    def _limit(self, size):
+        remaining = self.size - self.pos
+        return remaining if size is None or size < 0 else min(size, remaining)
+
+    def read(self, size=-1):
+        self.fp.seek(self.start + self.pos)
+        data = self.fp.read(self._limit(size))
+        self.pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        self.fp.seek(self.start + self.pos)
+        data = self.fp.readline(self._limit(size))
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos):
+        self.pos = max(0, min(pos, self.size))
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_PACKS = None # Pack name to index, loaded on first use
+
+def load_packs(reload=False):
+    """
+    Returns every pack's index, as {"shelves": {name: {filename: (offset, size)}},
+    "blobs": {digest: (offset, size)}}, keyed by pack name.
+    """
+    global _PACKS
+    if _PACKS is not None and not reload:
+        return _PACKS
+
+    _PACKS = {}
+    packs_dir = get_packs_dir()
+    if os.path.isdir(packs_dir):
+        for filename in sorted(os.listdir(packs_dir)):
+            if filename.endswith(PACK_INDEX_SUFFIX):
+                name = filename[:-len(PACK_INDEX_SUFFIX)]
+                _PACKS[name] = pickle.loads(open(join(packs_dir, filename), "rb").read())
+    return _PACKS
+
+def open_packed(pack_name, location):
+    offset, size = location
+    return SubFile(open(join(get_packs_dir(), pack_name + PACK_SUFFIX), "rb"), offset, size)
+
+def find_packed_shelf(name):
+    for pack_name, index in load_packs().iteritems():
+        if name in index["shelves"]:
+            return pack_name, index["shelves"][name]
+    return None, None
+
+def find_packed_blob(digest):
+    for pack_name, index in load_packs().iteritems():
+        if digest in index["blobs"]:
+            return pack_name, index["blobs"][digest]
+    return None, None
+
+def open_shelf_file(storage_path, filename):
+    """Opens one of a shelf's files, whether loose or packed."""
+    path = join(storage_path, filename)
+    if os.path.isfile(path):
+        return open(path, "rb")
+
+    pack_name, files = find_packed_shelf(os.path.basename(storage_path))
+    if files is None or filename not in files:
+        raise IOError(errno.ENOENT, "No such shelf file", path)
+    return open_packed(pack_name, files[filename])
+
+def open_blob(digest):
+    blob_path = get_blob_path(digest)
+    if os.path.isfile(blob_path):
+        return open(blob_path, "rb")
+
+    pack_name, location = find_packed_blob(digest)
+    if location is None:
+        raise IOError(errno.ENOENT, "No such blob", blob_path)
+    return open_packed(pack_name, location)
+
+def shelf_exists(id):
+    return os.path.isdir(get_storage_path(id)) or find_packed_shelf(str(id))[1] is not None
+
+def list_shelves():
+    """Returns the names of all shelves, loose and packed."""
+    names = set()
+    for name in os.listdir(CONFIG.local_storage):
+        if os.path.isfile(join(CONFIG.local_storage, name, META_FILENAME)):
+            names.add(name)
+    for index in load_packs().itervalues():
+        names.update(index["shelves"])
+    return sorted(names)
+
+
+def make_dirs(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path): # Lost a race with another shelve
+                raise
+
+
+def refresh_blob(blob_path):
+    """
+    Marks a loose blob as just used, returning whether it's stored. Reusing
+    a blob makes it new again, so garbage collection can't take it for an old
+    unreferenced one before the manifest referencing it is written.
+    """
+    try:
+        os.utime(blob_path, None)
+        return True
+    except OSError:
+        return False
+
+
+class BlobWriter(object):
+    """
+    Streams data into a new blob, compressing and hashing it as it's written.
+    The blob is written aside and only renamed into place once closed, so a
+    blob is never seen half written.
+    """
+    def __init__(self):
+        blobs_dir = join(CONFIG.local_storage, BLOBS_DIRNAME)
+        make_dirs(blobs_dir)
+
+        fd, self.temp_path = tempfile.mkstemp(dir=blobs_dir, prefix=".tmp")
+        self.fp = os.fdopen(fd, "wb")
+        self.sha1 = hashlib.sha1()
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL)
+        self.size = 0
+
+    def write(self, data):
+        self.sha1.update(data)
+        self.fp.write(self.compressor.compress(data))
+        self.size += len(data)
+
+    def close(self):
+        """Moves the blob into place, or drops it if already stored. Returns its digest."""
+        try:
+            self.fp.write(self.compressor.flush())
+            self.fp.close()
+
+            digest = self.sha1.hexdigest()
+            blob_path = get_blob_path(digest)
+            if not refresh_blob(blob_path):
+                make_dirs(os.path.dirname(blob_path))
+                try:
+                    os.rename(self.temp_path, blob_path)
+                except OSError:
+                    if not os.path.isfile(blob_path): # Windows won't rename over an existing blob
+                        raise
+            return digest
+        finally:
+            self.abort()
+
+    def abort(self):
+        self.fp.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def store_blob(data):
+    """Stores data as a compressed blob unless already present, returning its digest."""
+    digest = hashlib.sha1(data).hexdigest()
+    if refresh_blob(get_blob_path(digest)):
+        return digest
+
+    writer = BlobWriter()
+    writer.write(data)
+    return writer.close()
+
+def store_stream(fp):
+    """Stores everything read from fp as a blob, returning its digest."""
+    writer = BlobWriter()
+    try:
+        for data in iter(lambda: fp.read(READ_SIZE), ""):
+            writer.write(data)
+    except:
+        writer.abort()
+        raise
+    return writer.close()
+
+def iter_blob(digest):
+    """Yields a blob's content a piece at a time, checking it against its digest at the end."""
+    decompressor = zlib.decompressobj()
+    sha1 = hashlib.sha1()
+    with open_blob(digest) as fp:
+        while True:
+            compressed = fp.read(READ_SIZE)
+            data = decompressor.decompress(compressed) if compressed else decompressor.flush()
+            if data:
+                sha1.update(data)
+                yield data
+            if not compressed:
+                break
+
+    if sha1.hexdigest() != digest:
+        raise IOError("Blob %s is corrupt" % digest)
+
+def read_blob(digest):
+    return "".join(iter_blob(digest))
+
+
+def parse_patch(fp):
+    """
+    Reads svn diff output from fp a line at a time, splitting it at each
+    "Index:" line. Yields (entry, piece) for every piece read, where entry
+    indexes the file diff the piece belongs to: its path, offset and size
+    within the patch, number of hunks and whether it's binary, which svn
+    can't show the changes of. Anything before the first Index line gets a
+    path of None. Lines longer than READ_SIZE come in pieces, so only one
+    READ_SIZE piece of the diff is held in memory at a time.
+    """
+    entry = None
+    offset = 0
+    at_line_start = True
+    while True:
+        piece = fp.readline(READ_SIZE)
+        if not piece:
+            break
+
+        is_index = at_line_start and piece.startswith("Index: ")
+        while is_index and not piece.endswith("\n"):
+            # Index lines only hold a path, so always read them whole
+            more = fp.readline(READ_SIZE)
+            if not more:
+                break
+            piece += more
+
+        if entry is None or is_index:
+            path = INDEX_RE.match(piece).group(1).strip() if is_index else None
+            entry = {"path": path, "offset": offset, "size": 0, "hunks": 0}
+
+        if at_line_start and piece.startswith("@@ "):
+            entry["hunks"] += 1
+        elif at_line_start and piece.startswith(BINARY_MARKER):
+            entry["binary"] = True
+        entry["size"] += len(piece)
+        offset += len(piece)
+        at_line_start = piece.endswith("\n")
+        yield entry, piece
+
+def index_patch(fp):
+    """Returns the per-file index of a patch without storing it."""
+    index = []
+    for entry, piece in parse_patch(fp):
+        if not index or index[-1] is not entry:
+            index.append(entry)
+    return index
+
+def store_patch_stream(fp):
+    """
+    Reads svn diff output from fp and stores each file's diff as a blob
+    while it streams in. Returns the manifest, which is the patch's index
+    with the blob for each file.
+    """
+    manifest = []
+    writer = None
+    try:
+        for entry, piece in parse_patch(fp):
+            if not manifest or manifest[-1] is not entry:
+                if writer is not None:
+                    manifest[-1]["blob"] = writer.close()
+                manifest.append(entry)
+                writer = BlobWriter()
+            writer.write(piece)
+
+        if writer is not None:
+            manifest[-1]["blob"] = writer.close()
+            writer = None
+    finally:
+        if writer is not None:
+            writer.abort()
+
+    return manifest
+
+def write_manifest(storage_path, manifest):
+    open(join(storage_path, MANIFEST_FILENAME), "wb").write(pickle.dumps(manifest))
+
+def read_manifest(storage_path):
+    try:
+        with open_shelf_file(storage_path, MANIFEST_FILENAME) as fp:
+            return pickle.loads(fp.read())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+def read_meta(storage_path):
+    with open_shelf_file(storage_path, META_FILENAME) as fp:
+        return pickle.loads(fp.read())
+
+def read_shelf_index(storage_path):
+    """
+    Returns the per-file index of a shelf. That's the manifest for blob
+    stored shelves, while a plain patch file has to be scanned.
+    """
+    manifest = read_manifest(storage_path)
+    if manifest is None:
+        with open_shelf_file(storage_path, PATCH_FILENAME) as fp:
+            return index_patch(fp)
+    return manifest
+
+def iter_shelf_patch(storage_path, entries=None):
+    """
+    Yields the exact patch shelved at storage_path a piece at a time, from
+    either layout. Given entries from its index, only those files' diffs
+    are read.
+    """
+    manifest = read_manifest(storage_path)
+    if manifest is None:
+        with open_shelf_file(storage_path, PATCH_FILENAME) as fp:
+            if entries is None:
+                for data in iter(lambda: fp.read(READ_SIZE), ""):
+                    yield data
+                return
+
+            for entry in entries:
+                fp.seek(entry["offset"])
+                remaining = entry["size"]
+                while remaining > 0:
+                    data = fp.read(min(remaining, READ_SIZE))
+                    if not data:
+                        raise IOError("Patch is shorter than its index")
+                    remaining -= len(data)
+                    yield data
+        return
+
+    for entry in entries if entries is not None else manifest:
+        for data in iter_blob(entry["blob"]):
+            yield data
+
+def read_shelf_patch(storage_path, entries=None):
+    return "".join(iter_shelf_patch(storage_path, entries))
+
+def shelf_base_reader(storage_path):
+    """Returns a function giving the stored base of a path in the shelf's patch, or None."""
+    bases = dict((x["path"], x["base"]) for x in read_shelf_index(storage_path) if x.get("base"))
+    return lambda path: read_blob(bases[path]) if path in bases else None
+
+def extract_shelf_patch(storage_path, entries=None):
+    """Writes the shelf's patch, or just some of its files, to a temp file for svn/patch to apply; the caller removes it."""
+    fd, patch_filename = tempfile.mkstemp(prefix="shelf_", suffix=".patch")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            for data in iter_shelf_patch(storage_path, entries):
+                fp.write(data)
+    except:
+        os.remove(patch_filename)
+        raise
+    return patch_filename
+
+
+def replace_file(temp_path, path):
+    # Windows won't rename over an existing file
+    if os.name == "nt" and os.path.exists(path):
+        os.remove(path)
+    os.rename(temp_path, path)
+
+def write_pack_index(pack_name, index):
+    index_path = join(get_packs_dir(), pack_name + PACK_INDEX_SUFFIX)
+    open(index_path + ".tmp", "wb").write(pickle.dumps(index))
+    replace_file(index_path + ".tmp", index_path)
+
+def remove_pack(pack_name):
+    for suffix in [PACK_INDEX_SUFFIX, PACK_SUFFIX]:
+        path = join(get_packs_dir(), pack_name + suffix)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def shelf_blobs(name):
+    manifest = read_manifest(get_storage_path(name))
+    blobs = set()
+    for entry in manifest or []:
+        blobs.add(entry["blob"])
+        if entry.get("base"):
+            blobs.add(entry["base"])
+    return blobs
+
+def shelf_files_size(name):
+    """Bytes used by a shelf's own files, not counting its blobs."""
+    storage_path = get_storage_path(name)
+    if os.path.isdir(storage_path):
+        return sum(os.path.getsize(join(storage_path, x)) for x in os.listdir(storage_path))
+
+    pack_name, files = find_packed_shelf(name)
+    return sum(size for offset, size in files.itervalues()) if files else 0
+
+def blob_size(digest):
+    blob_path = get_blob_path(digest)
+    if os.path.isfile(blob_path):
+        return os.path.getsize(blob_path)
+
+    pack_name, location = find_packed_blob(digest)
+    return location[1] if location else 0
+
+
+def new_pack_name():
+    name = base_name = "pack-%s-%d" % (time.strftime("%Y%m%d%H%M%S"), os.getpid())
+    count = 0
+    while os.path.exists(join(get_packs_dir(), name + PACK_SUFFIX)):
+        count += 1
+        name = "%s-%d" % (base_name, count)
+    return name
+
+def write_pack(pack_name, shelves, blobs):
+    """
+    Writes the files of the given loose shelves and blobs into a new pack.
+    The pack is only visible once its index is renamed into place, so an
+    interrupted pack leaves nothing behind but a stray pack file.
+    """
+    packs_dir = get_packs_dir()
+    make_dirs(packs_dir)
+
+    index = {"shelves": {}, "blobs": {}}
+    with open(join(packs_dir, pack_name + PACK_SUFFIX), "wb") as pack:
+        def append(path):
+            start = pack.tell()
+            with open(path, "rb") as fp:
+                shutil.copyfileobj(fp, pack, READ_SIZE)
+            return start, pack.tell() - start
+
+        for name in shelves:
+            storage_path = get_storage_path(name)
+            index["shelves"][name] = files = {}
+            for filename in SHELF_FILENAMES:
+                path = join(storage_path, filename)
+                if os.path.isfile(path):
+                    files[filename] = append(path)
+
+        for digest in blobs:
+            index["blobs"][digest] = append(get_blob_path(digest))
+
+        pack.flush()
+        os.fsync(pack.fileno())
+        size = pack.tell()
+
+    write_pack_index(pack_name, index)
+    load_packs(reload=True)
+    return size
+
+def pack_shelves(names):
+    """
+    Moves the given loose shelves, and the loose blobs no other loose shelf
+    uses, into a new pack. Returns the pack's name and size.
+    """
+    names = [ x for x in names if os.path.isdir(get_storage_path(x)) ]
+    if not names:
+        return None, 0
+
+    # Blobs still used by a loose shelf stay loose, so the pack never needs rewriting for them
+    packing = set(names)
+    blobs = set()
+    for name in names:
+        blobs.update(shelf_blobs(name))
+    for name in os.listdir(CONFIG.local_storage):
+        if name not in packing and os.path.isfile(join(CONFIG.local_storage, name, META_FILENAME)):
+            blobs.difference_update(shelf_blobs(name))
+    blobs = sorted(x for x in blobs if os.path.isfile(get_blob_path(x)))
+
+    pack_name = new_pack_name()
+    size = write_pack(pack_name, names, blobs)
+
+    for name in names:
+        shutil.rmtree(get_storage_path(name))
+    for digest in blobs:
+        os.remove(get_blob_path(digest))
+    return pack_name, size
+
+
+def delete_shelves(names):
+    """Deletes shelves, whether loose or packed, then collects any blobs left unused."""
+    names = set(names)
+    for name in names:
+        storage_path = get_storage_path(name)
+        if os.path.isdir(storage_path):
+            shutil.rmtree(storage_path)
+
+    for pack_name, index in load_packs(reload=True).items():
+        if names.intersection(index["shelves"]):
+            for name in names:
+                index["shelves"].pop(name, None)
+            write_pack_index(pack_name, index)
+
+    collect_garbage()
+
+def collect_garbage():
+    """
+    Deletes loose blobs no shelf uses, drops such blobs from the pack indexes,
+    and then deletes packs with nothing left in them, or repacks those which
+    are mostly unused. Returns the number of bytes freed.
+    """
+    used = set()
+    for name in list_shelves():
+        used.update(shelf_blobs(name))
+
+    freed = 0
+    blobs_dir = join(CONFIG.local_storage, BLOBS_DIRNAME)
+    if os.path.isdir(blobs_dir):
+        cutoff = time.time() - BLOB_GRACE_PERIOD
+        for fanout in os.listdir(blobs_dir):
+            fanout_dir = join(blobs_dir, fanout)
+            if not os.path.isdir(fanout_dir):
+                continue
+            for filename in os.listdir(fanout_dir):
+                path = join(fanout_dir, filename)
+                if fanout + filename not in used and os.path.getmtime(path) < cutoff:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+
+    for pack_name, index in load_packs(reload=True).items():
+        unused = [ x for x in index["blobs"] if x not in used ]
+        for digest in unused:
+            del index["blobs"][digest]
+
+        pack_size = os.path.getsize(join(get_packs_dir(), pack_name + PACK_SUFFIX))
+        live_size = sum(size for files in index["shelves"].itervalues() for offset, size in files.itervalues())
+        live_size += sum(size for offset, size in index["blobs"].itervalues())
+
+        if not index["shelves"] and not index["blobs"]:
+            remove_pack(pack_name)
+            freed += pack_size
+        elif live_size < pack_size / 2:
+            freed += pack_size - repack(pack_name, index)
+        elif unused:
+            write_pack_index(pack_name, index)
+
+    load_packs(reload=True)
+    return freed
+
+def repack(pack_name, index):
+    """Copies what's still used in a pack to a new one and deletes the old. Returns the new size."""
+    new_name = new_pack_name()
+    new_index = {"shelves": {}, "blobs": {}}
+    with open(join(get_packs_dir(), new_name + PACK_SUFFIX), "wb") as pack:
+        def copy(location):
+            start = pack.tell()
+            with open_packed(pack_name, location) as fp:
+                shutil.copyfileobj(fp, pack, READ_SIZE)
+            return start, pack.tell() - start
+
+        for name, files in index["shelves"].iteritems():
+            new_index["shelves"][name] = dict((filename, copy(location)) for filename, location in files.iteritems())
+        for digest, location in index["blobs"].iteritems():
+            new_index["blobs"][digest] = copy(location)
+
+        pack.flush()
+        os.fsync(pack.fileno())
+        size = pack.tell()
+
+    write_pack_index(new_name, new_index)
+    remove_pack(pack_name)
+    return size